@@ -15,6 +15,9 @@
 # along with Sibyl. If not, see <http://www.gnu.org/licenses/>.
 
 
+from sibyl.commons import endianness
+
+
 class ABI(object):
     "Parent class, stand for an ABI"
 
@@ -24,6 +27,8 @@ class ABI(object):
     def __init__(self, jitter, ira):
         self.jitter = jitter
         self.ira = ira
+        # Byte order of the target, "little" or "big"
+        self.endianness = endianness(ira)
 
     def reset(self):
         "Reset the current ABI"
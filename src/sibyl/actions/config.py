@@ -17,6 +17,7 @@
 import os
 
 from sibyl.config import config, config_paths
+from sibyl.commons import print_table
 from sibyl.actions.action import Action
 
 
@@ -29,11 +30,15 @@ class ActionConfig(Action):
         (("-V", "--value"), {"help": "Return the value of a specific option"}),
         (("-d", "--dump"), {"help": "Dump the current configuration",
                             "action": "store_true"}),
+        (("-s", "--stats"), {"help": "Show tests statistics",
+                             "action": "store_true"}),
     ]
 
     def run(self):
         if self.args.dump:
             print("\n".join(config.dump()))
+        elif self.args.stats:
+            self.show_stats()
         elif self.args.value:
             if self.args.value.endswith("_keys") and hasattr(config, self.args.value[:-5]):
                 val = list(getattr(config, self.args.value[:-5]).keys())
@@ -100,8 +105,44 @@ class ActionConfig(Action):
         else:
             print("GHIDRA analyzeHeadless has been not found")
 
+        # Cache
+        if config.cache_path:
+            print("Results cache: %s (up to %d entries)" % (config.cache_path,
+                                                          config.cache_max_entries))
+        else:
+            print("Results cache is deactivated")
+
+        # Tests statistics
+        if config.cache_path:
+            from sibyl.stats import TestStats
+            stats = TestStats(config.cache_path)
+            nb_tests = len(set(test for test, _ in stats.stats))
+            print("Statistics recorded for %d tests (use -s to show them)" % nb_tests)
+
         # Tests
         print("Tests availables:")
         for name, tests in config.available_tests.items():
             print("\t%s (%d)" % (name, len(tests)))
             print("\t\t" + ", ".join(test.func for test in tests))
+
+    def show_stats(self):
+        if not config.cache_path:
+            print("Results cache is deactivated, no statistics available")
+            return
+
+        from sibyl.stats import TestStats
+        stats = TestStats(config.cache_path)
+        ligs = [["Test", "Runs", "Reject rate", "First sub-test rejects",
+                 "Mean time (ms)"]]
+        for test, subtest in sorted(stats.stats):
+            runs, rejects, first_rejects, elapsed = stats.get(test, subtest)
+            if subtest == stats.ALL:
+                name = test
+                first = "%.1f%%" % (100. * first_rejects / runs)
+            else:
+                name = "  %s" % subtest
+                first = ""
+            ligs.append([name, "%d" % runs,
+                         "%.1f%%" % (100. * rejects / runs), first,
+                         "%.3f" % (1000. * elapsed / runs)])
+        print_table(ligs, separator="| ")
@@ -14,37 +14,106 @@
 # You should have received a copy of the GNU General Public License
 # along with Sibyl. If not, see <http://www.gnu.org/licenses/>.
 
+import os
 import logging
 import json
+import signal
 import sys
-from collections import namedtuple
+import time
+import asyncio
+import shutil
+import tempfile
+from collections import namedtuple, deque
 
 from miasm.analysis.machine import Machine
 from miasm.analysis.binary import Container
+from miasm.core.locationdb import LocationDB
 
 from sibyl.config import config
 from sibyl.testlauncher import TestLauncher
 from sibyl.abi import ABIS
 from sibyl.heuristics.arch import ArchHeuristic
 from sibyl.commons import print_table
+from sibyl.checkpoint import Checkpoint
+from sibyl.cache import ResultCache, function_hashes
+from sibyl.stats import TestStats
+from sibyl.timeout import TimeoutPolicy, AdaptiveTimeout
 from sibyl.actions.action import Action
 
-# Message exchanged with workers
-MessageTaskDone = namedtuple("MessageTaskDone", ["address", "results"])
-
-
-class FakeProcess(object):
-    """Mock simulating Process API in monoprocess mode"""
-
-    def __init__(self, target, args):
-        self.target = target
-        self.args = args
-
-    def start(self, *args, **kwargs):
-        self.target(*self.args)
-
-    def join(self, *args, **kwargs):
-        pass
+# Message sent by workers for each processed chunk
+# results: list of (address, possible functions, elapsed time)
+# elapsed: time spent on these addresses, in seconds
+MessageTaskDone = namedtuple("MessageTaskDone", ["results", "elapsed"])
+
+# Targeted duration of a chunk of addresses sent to a worker, in seconds
+CHUNK_DURATION = 0.5
+# Maximum number of addresses in a chunk
+CHUNK_MAX = 1024
+# Period of workers status checks, in seconds
+WATCH_PERIOD = 0.5
+# Number of workers, per worker process, which may die in a row outside of
+# an address (while starting, ...) before giving up
+MAX_RESPAWNS = 3
+
+# (machine, container) of the binary to fingerprint, inherited by
+# fingerprinting processes
+_fingerprint_target = None
+
+
+def _fingerprint(address):
+    """Return @address and the hashes of its function code"""
+    machine, container = _fingerprint_target
+    return address, function_hashes(machine, container, address)
+
+
+class Worker(object):
+    """Master side of a worker process"""
+
+    def __init__(self, target):
+        """Start a worker process running @target(connection, progress)"""
+        from multiprocessing import Array, Pipe, Process
+
+        self.conn, child_conn = Pipe()
+        # Index of the address under test in the current chunk, and time at
+        # which its test started (0 if none)
+        self.progress = Array("d", 2, lock=False)
+        self.process = Process(target=target,
+                               args=(child_conn, self.progress),
+                               daemon=True)
+        self.process.start()
+        child_conn.close()
+        # Chunk of addresses being processed
+        self.chunk = None
+
+    def current(self):
+        """Return (index in chunk, start time) of the address being tested,
+        or None"""
+        start_time = self.progress[1]
+        index = int(self.progress[0])
+        if not start_time or start_time != self.progress[1]:
+            return None
+        return index, start_time
+
+    def send(self, chunk):
+        self.chunk = chunk
+        try:
+            self.conn.send(chunk)
+        except ConnectionError:
+            # The worker died, its chunk is requeued on its death detection
+            pass
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except ConnectionError:
+            pass
+        self.process.join()
+        self.conn.close()
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
 
 
 class ActionFind(Action):
@@ -72,9 +141,10 @@ class ActionFind(Action):
                                "increase verbosity level)",
                                "action": "count",
                                "default": 0}),
-        (["-i", "--timeout"], {"help": "Test timeout (in seconds)",
+        (["-i", "--timeout"], {"help": "Test timeout (in seconds, may be " \
+                               "fractional)",
                                "default": 2,
-                               "type": int}),
+                               "type": float}),
         (["-m", "--mapping-base"], {"help": "Binary mapping address",
                                     "default": "0"}),
         (["-j", "--jitter"], {"help": "Jitter engine (override default one)",
@@ -83,46 +153,330 @@ class ActionFind(Action):
         (["-p", "--monoproc"], {"help": "Launch tests in a single process " \
                                 "(mainly for debug purpose)",
                                 "action": "store_true"}),
-        (["-o", "--output-format"], {"help": "Output format",
-                                     "choices": ["JSON", "human"],
+        (["-o", "--output-format"], {"help": "Output format (NDJSON: one " \
+                                     "line per address, as soon as it is " \
+                                     "done)",
+                                     "choices": ["JSON", "NDJSON", "human"],
                                      "default": "human"}),
+        (["-l", "--load-once"], {"help": "Load the binary and initialize " \
+                                 "tests once, before forking workers",
+                                 "action": "store_true"}),
+        (["-c", "--checkpoint"], {"help": "Append results to this file, " \
+                                  "and skip addresses it already contains " \
+                                  "(resume an interrupted run)"}),
+        (["-n", "--no-cache"], {"help": "Do not use the persistent results " \
+                                "cache",
+                                "action": "store_true"}),
+        (["-d", "--no-dedup"], {"help": "Do not group identical functions " \
+                                "before testing them",
+                                "action": "store_true"}),
+        (["-P", "--no-probe"], {"help": "Do not rule out tests through a " \
+                                "shared probe input",
+                                "action": "store_true"}),
+        (["-T", "--address-timeout"], {"help": "Wall-clock budget for all " \
+                                       "the tests of an address (in " \
+                                       "seconds, 0 to disable). Workers " \
+                                       "exceeding it are restarted",
+                                       "default": 60,
+                                       "type": int}),
+        (["-B", "--batch"], {"help": "Prepare each sub-test once for a " \
+                             "whole chunk of addresses",
+                             "action": "store_true"}),
+        (["-S", "--seed"], {"help": "Seed of random test inputs, to " \
+                            "reproduce a run",
+                            "type": int}),
+        (["-C", "--no-crash-skip"], {"help": "Do not skip the remaining " \
+                                     "tests of a function crashing " \
+                                     "independently of its inputs",
+                                     "action": "store_true"}),
+        (["-u", "--budget"], {"help": "Maximum number of instructions (basic " \
+                              "blocks with Miasm engines) executed by a " \
+                              "test, instead of its timeout",
+                              "type": int}),
+        (["-A", "--adaptive"], {"help": "Bound the tests of a function " \
+                                "relatively to the instructions executed by " \
+                                "its first run returning normally. Runs " \
+                                "before it are bounded by the budget (-u), " \
+                                "%d by default" % AdaptiveTimeout.FIRST_BUDGET,
+                                "action": "store_true"}),
     ]
 
-    def do_test(self, addr_queue, msg_queue):
-        """Multi-process worker for launching on functions"""
+    def timeout_policy(self):
+        """Return the TimeoutPolicy instance requested by the user"""
+        if self.args.adaptive:
+            return AdaptiveTimeout(first_budget=(self.args.budget or
+                                                 AdaptiveTimeout.FIRST_BUDGET))
+        return TimeoutPolicy()
 
-        # Init components
+    def init_launcher(self):
+        """Return a TestLauncher on the target binary"""
         tl = TestLauncher(self.args.filename, self.machine, self.abicls,
-                          self.tests, self.args.jitter, self.map_addr)
+                          self.tests, self.args.jitter, self.map_addr,
+                          early_quit_all=self.timeout_policy(),
+                          snapshot_dir=self.snapshot_dir, cache=self.cache,
+                          probe=not self.args.no_probe, stats=self.stats,
+                          seed=self.args.seed,
+                          crash_skip=not self.args.no_crash_skip,
+                          budget=self.args.budget)
+        tl.function_hashes = self.function_hashes
 
         # Activatate logging INFO on at least -vv
         if self.args.verbose > 1:
             tl.logger.setLevel(logging.INFO)
+        return tl
+
+    def do_test(self, conn, progress):
+        """Multi-process worker for launching on functions"""
+
+        # Forked from the master event loop: do not forward signals to it,
+        # and let the master stop workers
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+        # Init components, unless inherited from the master process
+        tl = self.launcher
+        if tl is None:
+            tl = self.init_launcher()
 
         # Main loop
         while True:
-            address = addr_queue.get()
-            if address is None:
+            addresses = conn.recv()
+            if addresses is None:
                 break
-            possible_funcs = tl.run(address, timeout_seconds=self.args.timeout)
-            msg_queue.put(MessageTaskDone(address, possible_funcs))
+            start_time = time.monotonic()
+            results = []
+            if self.args.batch:
+                indexes = {address: index
+                           for index, address in enumerate(addresses)}
+
+                def set_progress(address):
+                    progress[1] = 0
+                    progress[0] = indexes[address]
+                    progress[1] = time.monotonic()
+
+                tl.progress = set_progress
+                possible_funcs = tl.run_batch(addresses,
+                                              timeout_seconds=self.args.timeout)
+                elapsed = (time.monotonic() - start_time) / len(addresses)
+                results = [(address, possible_funcs[address], elapsed)
+                           for address in addresses]
+                addresses = []
+            for index, address in enumerate(addresses):
+                progress[1] = 0
+                progress[0] = index
+                progress[1] = time.monotonic()
+                possible_funcs = tl.run(address,
+                                        timeout_seconds=self.args.timeout)
+                results.append((address, possible_funcs,
+                                time.monotonic() - progress[1]))
+            progress[1] = 0
+            if self.stats is not None:
+                self.stats.flush()
+            conn.send(MessageTaskDone(results, time.monotonic() - start_time))
+
+    def fingerprint(self, addresses, nb_workers):
+        """Return a dictionary address -> (portable hash, local hash) of the
+        code of functions at @addresses, computed by @nb_workers processes"""
+        global _fingerprint_target
+        from multiprocessing import Pool
+
+        container = Container.from_stream(open(self.args.filename, 'rb'),
+                                          LocationDB(), addr=self.map_addr)
+        _fingerprint_target = (self.machine, container)
+        if nb_workers == 1:
+            return dict(_fingerprint(address) for address in addresses)
+        with Pool(nb_workers) as pool:
+            return dict(pool.imap_unordered(_fingerprint, addresses,
+                                            chunksize=16))
+
+    def run_inline(self, addresses):
+        """Test @addresses in the current process, and yield
+        (address, possible functions, error, elapsed time)"""
+        try:
+            if self.args.batch:
+                for index in range(0, len(addresses), CHUNK_MAX):
+                    chunk = addresses[index:index + CHUNK_MAX]
+                    start_time = time.monotonic()
+                    possible_funcs = self.launcher.run_batch(
+                        chunk, timeout_seconds=self.args.timeout)
+                    elapsed = (time.monotonic() - start_time) / len(chunk)
+                    for address in chunk:
+                        yield address, possible_funcs[address], None, elapsed
+                return
+            for address in addresses:
+                start_time = time.monotonic()
+                possible_funcs = self.launcher.run(
+                    address, timeout_seconds=self.args.timeout)
+                yield (address, possible_funcs, None,
+                       time.monotonic() - start_time)
+        finally:
+            if self.stats is not None:
+                self.stats.flush()
+
+    def next_chunk(self, pending, nb_workers):
+        """Pop the next chunk of @pending addresses to send to a worker
+
+        The chunk size is adapted to the observed time per address, to
+        amortize the communication cost while keeping the workload balanced
+        """
+        nb_done, total_time = self.chunk_stats
+        size = 1
+        if nb_done and total_time:
+            size = int(CHUNK_DURATION * nb_done / total_time)
+        size = max(1, min(size, len(pending) // (2 * nb_workers), CHUNK_MAX))
+        return [pending.popleft() for _ in range(size)]
+
+    async def supervise(self, addresses, nb_workers):
+        """Test @addresses using @nb_workers processes, and asynchronously
+        yield (address, possible functions, error, elapsed time) as they are
+        available
+
+        A worker exceeding the per-address budget, or dying while testing an
+        address, is replaced. This address is reported with the error
+        "timeout" or "crash", and the rest of its chunk is tested again. A
+        worker dying outside of an address (while starting, between two
+        addresses) is also replaced, and its whole chunk tested again.
+
+        If the consumer stops iterating before the end (generator closed,
+        task cancelled), busy workers are killed.
+        """
+        loop = asyncio.get_running_loop()
+        ready = asyncio.Event()
+
+        pending = deque(addresses)
+        self.chunk_stats = [0, 0.0]  # processed addresses, total time
+        budget = self.args.address_timeout
+        # Workers died in a row outside of an address
+        respawns = 0
+        workers = [Worker(self.do_test) for _ in range(nb_workers)]
+        try:
+            for worker in workers:
+                if pending:
+                    worker.send(self.next_chunk(pending, nb_workers))
+
+            while True:
+                busy = [worker for worker in workers
+                        if worker.chunk is not None]
+                if not busy:
+                    break
 
-        # Signal to master the end
-        msg_queue.put(None)
+                # Wait for a message or the death of a worker, or the next
+                # check
+                fds = ([worker.conn.fileno() for worker in busy] +
+                       [worker.process.sentinel for worker in busy])
+                for fd in fds:
+                    loop.add_reader(fd, ready.set)
+                try:
+                    await asyncio.wait_for(ready.wait(), WATCH_PERIOD)
+                except asyncio.TimeoutError:
+                    pass
+                finally:
+                    for fd in fds:
+                        loop.remove_reader(fd)
+                    ready.clear()
+
+                for worker in busy:
+                    msg = None
+                    if worker.conn.poll():
+                        try:
+                            msg = worker.conn.recv()
+                        except (EOFError, ConnectionError):
+                            # The worker died
+                            pass
+                    if msg is not None:
+                        respawns = 0
+                        worker.chunk = None
+                        self.chunk_stats[0] += len(msg.results)
+                        self.chunk_stats[1] += msg.elapsed
+                        if pending:
+                            worker.send(self.next_chunk(pending, nb_workers))
+                        for address, possible_funcs, elapsed in msg.results:
+                            yield address, possible_funcs, None, elapsed
+                        continue
+
+                    current = worker.current()
+                    if worker.process.is_alive():
+                        if (not budget or current is None or
+                            time.monotonic() - current[1] < budget):
+                            continue
+                        error = "timeout"
+                    elif current is None:
+                        respawns += 1
+                        if respawns > MAX_RESPAWNS * nb_workers:
+                            raise RuntimeError("An error occured: workers "
+                                               "keep dying")
+                    else:
+                        error = "crash"
+
+                    # Replace the worker, and requeue its remaining addresses
+                    worker.kill()
+                    if current is None:
+                        pending.extendleft(reversed(worker.chunk))
+                    else:
+                        elapsed = time.monotonic() - current[1]
+                        index = current[0]
+                        pending.extendleft(reversed(worker.chunk[:index] +
+                                                    worker.chunk[index + 1:]))
+                    new_worker = Worker(self.do_test)
+                    workers[workers.index(worker)] = new_worker
+                    if pending:
+                        new_worker.send(self.next_chunk(pending, nb_workers))
+                    if current is not None:
+                        yield worker.chunk[index], [], error, elapsed
+        finally:
+            for worker in workers:
+                if worker.chunk is None:
+                    worker.stop()
+                else:
+                    worker.kill()
+
+    async def consume(self, tasks, callback):
+        """Call @callback on each result from the asynchronous iterator
+        @tasks
+
+        SIGINT and SIGTERM cancel the consumption, closing @tasks; the
+        resulting asyncio.CancelledError is raised"""
+        loop = asyncio.get_running_loop()
+        task = asyncio.current_task()
+        signums = [signal.SIGINT, signal.SIGTERM]
+        for signum in signums:
+            loop.add_signal_handler(signum, task.cancel)
+        try:
+            async for result in tasks:
+                callback(*result)
+        finally:
+            await tasks.aclose()
+            for signum in signums:
+                loop.remove_signal_handler(signum)
+
+    def information(self, addresses):
+        """Return the description of the run on @addresses, for JSON
+        outputs"""
+        timeout_policy = self.timeout_policy().describe()
+        timeout_policy.update({"timeout": self.args.timeout,
+                               "budget": self.args.budget})
+        return {"total_count": len(addresses),
+                "test_cases": len(self.tests),
+                "timeout_policy": timeout_policy}
+
+    @staticmethod
+    def print_result(address, possible_funcs, error):
+        """Print the result of @address as a NDJSON line"""
+        print(json.dumps({"address": address,
+                          "functions": possible_funcs,
+                          "error": error}), flush=True)
 
     def run(self):
         """Launch search"""
 
         # Import multiprocessing only when required
-        from multiprocessing import cpu_count, Queue, Process, set_start_method
+        from multiprocessing import cpu_count, set_start_method
 
         set_start_method('fork')
 
         # Parse args
         self.map_addr = int(self.args.mapping_base, 0)
-        if self.args.monoproc:
-            cpu_count = lambda: 1
-            Process = FakeProcess
 
         # Architecture
         architecture = False
@@ -182,6 +536,10 @@ class ActionFind(Action):
         if self.args.verbose > 0:
             print("Found %d test cases" % len(self.tests))
 
+        if self.args.output_format == "NDJSON":
+            print(json.dumps({"information": self.information(addresses)}),
+                  flush=True)
+
         # Single process check
         # for address in addresses:
         #     print('!!! 0x{:x}'.format(address))
@@ -191,71 +549,141 @@ class ActionFind(Action):
         #     print(address, possible_funcs)
         # return
 
-        # Prepare multiprocess
-        cpu_c = cpu_count()
-        addr_queue = Queue()
-        msg_queue = Queue()
-        processes = []
-
-        # Add tasks
-        for address in addresses:
-            addr_queue.put(address)
-
-        # Add poison pill
-        for _ in range(cpu_c):
-            addr_queue.put(None)
-
-        # Launch workers
-        for _ in range(cpu_c):
-            p = Process(target=self.do_test, args=(addr_queue, msg_queue))
-            processes.append(p)
-            p.start()
-
         # Get results
-        nb_poison = 0
         results = {}  # address -> possible functions
-        while nb_poison < cpu_c:
-            msg = msg_queue.get()
-            # Poison pill
-            if msg is None:
-                nb_poison += 1
-                continue
-
-            # Save result
-            results[msg.address] = msg.results
-
-            # Display status if needed
+        errors = {}  # address -> error
+
+        # Resume from checkpoint
+        checkpoint = None
+        todo = addresses
+        if self.args.checkpoint:
+            run_info = {"binary": Checkpoint.file_hash(self.args.filename),
+                        "architecture": architecture,
+                        "abi": abicls.__name__,
+                        "mapping_base": self.map_addr,
+                        "tests": sorted(test.__name__ for test in self.tests)}
+            try:
+                checkpoint = Checkpoint(self.args.checkpoint, run_info)
+            except ValueError as error:
+                sys.stderr.write("%s, use another checkpoint file\n" % error)
+                sys.exit(1)
+            for address in addresses:
+                if address in checkpoint.results:
+                    results[address] = checkpoint.results[address]["functions"]
+                    if checkpoint.results[address]["error"]:
+                        errors[address] = checkpoint.results[address]["error"]
+                    if self.args.output_format == "human" and results[address]:
+                        print("0x%08x : %s" % (address,
+                                               ",".join(results[address])))
+                    elif self.args.output_format == "NDJSON":
+                        self.print_result(address, results[address],
+                                          errors.get(address))
+            todo = [address for address in addresses if address not in results]
+            if self.args.verbose > 0:
+                print("Resuming: %d addresses already done" % len(results))
+
+        # Group identical functions, to test only one of them:
+        # tested address -> addresses sharing its result
+        groups = {}
+        self.function_hashes = {}
+        if self.args.no_dedup:
+            groups = {address: [address] for address in todo}
+        else:
+            hashes = self.fingerprint(todo,
+                                      1 if self.args.monoproc else cpu_count())
+            self.function_hashes = {address: func_hash
+                                    for address, (func_hash, _) in hashes.items()}
+            representatives = {}  # local hash -> tested address
+            for address in todo:
+                local_hash = hashes[address][1]
+                tested = address
+                if local_hash is not None:
+                    tested = representatives.setdefault(local_hash, address)
+                groups.setdefault(tested, []).append(address)
             if self.args.verbose > 0:
-                sys.stdout.write("\r%d / %d" % (len(results), len(addresses)))
-                sys.stdout.flush()
-            if msg.results and self.args.output_format == "human":
-                prefix = ""
+                print("Found %d distinct functions" % len(groups))
+        todo = list(groups)
+
+        # Results cache, shared by workers
+        self.cache = None
+        if not self.args.no_cache and config.cache_path:
+            self.cache = ResultCache(config.cache_path,
+                                     config.cache_max_entries)
+            self.cache.evict()
+
+        # Tests statistics, used to schedule them
+        self.stats = None
+        if config.cache_path:
+            self.stats = TestStats(config.cache_path)
+
+        # Workers share their memory snapshot through this directory
+        self.snapshot_dir = tempfile.mkdtemp(prefix="sibyl-")
+
+        # Fully initialize the launcher in the master, workers get it through
+        # fork (copy-on-write)
+        self.launcher = None
+        if self.args.load_once or self.args.monoproc:
+            self.launcher = self.init_launcher()
+
+        def handle(tested, possible_funcs, error, elapsed):
+            """Handle the result of the @tested address"""
+            for address in groups[tested]:
+                # Save result
+                results[address] = possible_funcs
+                if error:
+                    errors[address] = error
+                if checkpoint is not None:
+                    checkpoint.add(address, possible_funcs, error,
+                                   elapsed if address == tested else 0.)
+
+                # Display status if needed
                 if self.args.verbose > 0:
-                    prefix = "\r"
-                print(prefix + "0x%08x : %s" % (msg.address, ",".join(msg.results)))
+                    sys.stdout.write("\r%d / %d" % (len(results),
+                                                    len(addresses)))
+                    sys.stdout.flush()
+                if self.args.output_format == "human":
+                    prefix = ""
+                    if self.args.verbose > 0:
+                        prefix = "\r"
+                    if possible_funcs:
+                        print(prefix + "0x%08x : %s" % (
+                            address, ",".join(possible_funcs)))
+                    elif error and self.args.verbose > 0:
+                        print(prefix + "0x%08x : (%s)" % (address, error))
+                elif self.args.output_format == "NDJSON":
+                    self.print_result(address, possible_funcs, error)
+
+        self.interrupted = False
+        try:
+            if self.args.monoproc:
+                for task in self.run_inline(todo):
+                    handle(*task)
+            else:
+                asyncio.run(self.consume(self.supervise(todo, cpu_count()),
+                                         handle))
+        except (asyncio.CancelledError, BrokenPipeError):
+            # Stopped by the consumer: interrupted by a signal, or output
+            # closed
+            self.interrupted = True
+        finally:
+            shutil.rmtree(self.snapshot_dir)
+            if checkpoint is not None:
+                checkpoint.close()
+        if self.interrupted:
+            # Avoid another error on flushing a closed output at exit
+            sys.stdout = open(os.devnull, "w")
+            sys.exit(1)
 
         # Clean output if needed
         if self.args.verbose > 0:
             print("")
 
-        # End connexions
-        msg_queue.close()
-        msg_queue.join_thread()
-        for p in processes:
-            p.join()
-
-        if not addr_queue.empty():
-            raise RuntimeError("An error occured: queue is not empty")
-
-        addr_queue.close()
-        addr_queue.join_thread()
-
         # Print final results
         if self.args.output_format == "JSON":
             # Expand results to always have the same key, and address as int
-            print(json.dumps({"information": {"total_count": len(addresses),
-                                              "test_cases": len(self.tests)},
-                              "results": [{"address": addr, "functions": result}
+            print(json.dumps({"information": self.information(addresses),
+                              "results": [{"address": addr, "functions": result,
+                                           "error": errors.get(addr)}
                                           for addr, result in results.items()],
             }))
         elif self.args.output_format == "human" and self.args.verbose > 0:
@@ -0,0 +1,231 @@
+"""Persistent cache of `TestLauncher.run` results
+
+Results are keyed by a hash of the function code, so that the same function
+statically linked in several binaries is identified only once.
+"""
+
+import os
+import json
+import time
+import marshal
+import hashlib
+import logging
+import sqlite3
+
+from miasm.core.asmblock import AsmBlockBad, log_asmblock
+from miasm.core.locationdb import LocationDB
+
+from sibyl.test.test import TestSet
+
+# Maximum number of basic blocks hashed for a function. Bigger functions are
+# not cached
+MAX_BLOCKS = 500
+
+
+def function_hashes(machine, container, address):
+    """Return hashes (portable, local) of the code of the function at
+    @address, or (None, None) if they cannot be computed
+    @machine: miasm.analysis.machine:Machine instance
+    @container: miasm.analysis.binary:Container instance of the binary
+
+    Hashes do not depend on the function location: blocks are hashed with
+    their offset relative to @address. Callees are not disassembled:
+    - the portable hash identifies copies of a function among binaries. As
+    callees may differ from a binary to another, there is no portable hash
+    for functions transferring control out of their code;
+    - in the local hash, branches and calls out of the function are hashed
+    with their absolute destination. It identifies copies of a function
+    inside a binary.
+
+    Instructions referencing data through the PC (literals, tables, calls to
+    a PC thunk, ...) are hashed in the local hash with their semantic, the PC
+    being resolved: only copies referencing the same data share it. As this
+    data may differ from a binary to another, there is no portable hash for
+    such functions, nor for functions accessing memory at a constant address
+    or branching indirectly.
+    """
+    mdis = machine.dis_engine(container.bin_stream, loc_db=container.loc_db)
+    mdis.blocs_wd = MAX_BLOCKS + 1
+
+    cur_log_level = log_asmblock.level
+    log_asmblock.setLevel(logging.CRITICAL)
+    try:
+        asmcfg = mdis.dis_multiblock(address)
+    except Exception:
+        return None, None
+    finally:
+        log_asmblock.setLevel(cur_log_level)
+
+    blocks = list(asmcfg.blocks)
+    if len(blocks) > MAX_BLOCKS:
+        return None, None
+
+    lines = sorted(((line.offset, line)
+                    for block in blocks
+                    for line in block.lines), key=lambda x: x[0])
+    if any(isinstance(block, AsmBlockBad) for block in blocks) or not lines:
+        return None, None
+
+    digest, local_digest = hashlib.sha256(), hashlib.sha256()
+    lifter = machine.lifter(LocationDB())
+    portable = True
+    inner = set(offset for offset, _ in lines)
+    for offset, line in lines:
+        position = b"%x:" % (offset - address)
+        data = container.bin_stream.getbytes(offset, line.l)
+        digest.update(position + data)
+        local_digest.update(position)
+
+        if line.dstflow():
+            dsts = line.getdstflow(container.loc_db)
+            if not all(dst.is_loc() or dst.is_int() for dst in dsts):
+                # Indirect branch
+                portable = False
+            dsts = [container.loc_db.get_location_offset(dst.loc_key)
+                    for dst in dsts if dst.is_loc()]
+            if dsts and not inner.issuperset(dsts):
+                # Control transferred out of the function
+                portable = False
+                local_digest.update(("%s->%s" % (line.name, dsts)).encode())
+                if line.is_subcall() and any(is_pc_thunk(mdis, lifter, dst)
+                                             for dst in dsts):
+                    # The callee returns the PC: hash its value
+                    local_digest.update(b"PC=%x" % (offset + line.l))
+                continue
+        if any(lifter.pc in arg.get_r(mem_read=True) for arg in line.args):
+            # Data referenced through the PC: hash the instruction semantic,
+            # with the PC resolved by the lifter
+            portable = False
+            assignblk, extra_irblocks = lifter.instr2ir(line)
+            local_digest.update(position + str(assignblk).encode())
+            for irblock in extra_irblocks:
+                local_digest.update(str(irblock).encode())
+            continue
+        elif any(arg.is_mem() and arg.ptr.is_int() for arg in line.args):
+            portable = False
+        local_digest.update(data)
+    return (digest.hexdigest() if portable else None,
+            local_digest.hexdigest())
+
+
+def describe(value):
+    """Return a string describing @value, without object addresses
+
+    Functions are described by their qualified name, and TestSet by their
+    structure"""
+    if hasattr(value, "__code__"):
+        return value.__qualname__
+    if isinstance(value, dict):
+        items = sorted("%s: %s" % (describe(key), describe(item))
+                       for key, item in value.items())
+        return "{%s}" % ", ".join(items)
+    if isinstance(value, (set, frozenset)):
+        return "{%s}" % ", ".join(sorted(describe(item) for item in value))
+    if isinstance(value, (list, tuple)):
+        return "[%s]" % ", ".join(describe(item) for item in value)
+    if isinstance(value, TestSet):
+        return "%s(%s)" % (value.__class__.__name__, describe(vars(value)))
+    return repr(value)
+
+
+def is_pc_thunk(mdis, lifter, address):
+    """Return True if the function at @address returns its return address,
+    that is the PC of its caller (e.g. i386 __x86.get_pc_thunk.*:
+    'mov reg, [sp]; ret')
+    @mdis: disassembly engine of the binary
+    @lifter: lifter of its architecture
+    """
+    try:
+        load = mdis.dis_instr(address)
+        ret = mdis.dis_instr(address + load.l)
+    except Exception:
+        return False
+    return (load.name == "MOV" and load.args[1].is_mem() and
+            load.args[1].ptr == lifter.sp and ret.name == "RET")
+
+
+def tests_version(tests_cls):
+    """Return a hash identifying the implementation of @tests_cls: code and
+    attributes (test data, TestSet, ...) of their classes"""
+    digest = hashlib.sha256()
+    for testcls in sorted(tests_cls, key=lambda cls: cls.__name__):
+        digest.update(testcls.__name__.encode())
+        for cls in testcls.__mro__:
+            for name, value in sorted(vars(cls).items()):
+                code = getattr(value, "__code__", None)
+                if code is not None:
+                    digest.update(name.encode())
+                    digest.update(marshal.dumps(code))
+                elif not name.startswith("__"):
+                    digest.update(("%s=%s" % (name,
+                                              describe(value))).encode())
+    return digest.hexdigest()
+
+
+class SQLiteStore(object):
+    """SQLite database in a directory, shared by concurrent processes"""
+
+    # Database file name, and schema
+    filename = None
+    schema = None
+
+    def __init__(self, directory):
+        self.path = os.path.join(directory, self.filename)
+        self._conn = None
+        self._pid = None
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    @property
+    def conn(self):
+        """Connection to the database, not shared with forked processes"""
+        if self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=60,
+                                         isolation_level=None)
+            self._conn.execute(self.schema)
+            self._pid = os.getpid()
+        return self._conn
+
+
+class ResultCache(SQLiteStore):
+    """On-disk cache: key -> possible functions
+
+    Least recently used entries are evicted beyond @max_entries.
+    """
+
+    filename = "results.sqlite"
+    schema = ("CREATE TABLE IF NOT EXISTS results ("
+              "key TEXT PRIMARY KEY, "
+              "functions TEXT, "
+              "last_used REAL)")
+
+    def __init__(self, directory, max_entries):
+        super(ResultCache, self).__init__(directory)
+        self.max_entries = max_entries
+
+    @staticmethod
+    def key(*elements):
+        """Return a cache key from the strings @elements"""
+        return hashlib.sha256("\0".join(elements).encode()).hexdigest()
+
+    def get(self, key):
+        """Return the cached possible functions for @key, or None"""
+        row = self.conn.execute("SELECT functions FROM results WHERE key = ?",
+                                (key,)).fetchone()
+        if row is None:
+            return None
+        self.conn.execute("UPDATE results SET last_used = ? WHERE key = ?",
+                          (time.time(), key))
+        return json.loads(row[0])
+
+    def set(self, key, functions):
+        """Associate @functions to @key"""
+        self.conn.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?)",
+                          (key, json.dumps(functions), time.time()))
+
+    def evict(self):
+        """Remove least recently used entries beyond the maximum size"""
+        self.conn.execute("DELETE FROM results WHERE key IN ("
+                          "SELECT key FROM results ORDER BY last_used DESC "
+                          "LIMIT -1 OFFSET ?)", (self.max_entries,))
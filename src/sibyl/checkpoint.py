@@ -0,0 +1,78 @@
+"""Checkpoint of `sibyl find` results, to resume interrupted runs"""
+
+import os
+import json
+import hashlib
+
+
+class Checkpoint(object):
+    """Append-only file of results
+
+    The first line describes the run (binary hash, ABI, tests, ...). Each
+    following line is the JSON result of an address:
+    {"address", "functions", "error", "elapsed"}
+    """
+
+    def __init__(self, filename, run_info):
+        """Open the checkpoint @filename, loading already known results
+        @run_info: dictionary describing the run. Results are reused only if
+        it matches the one of the checkpoint
+        """
+        self.filename = filename
+        self.run_info = run_info
+        # address -> result
+        self.results = {}
+
+        if os.path.exists(filename) and os.path.getsize(filename):
+            complete = self._load()
+            self.fdesc = open(filename, "a")
+            if not complete:
+                # Terminate the truncated line
+                self.fdesc.write("\n")
+        else:
+            self.fdesc = open(filename, "w")
+            self._write(run_info)
+
+    @staticmethod
+    def file_hash(filename):
+        """Return the SHA-256 of @filename content"""
+        digest = hashlib.sha256()
+        with open(filename, "rb") as fdesc:
+            for block in iter(lambda: fdesc.read(1 << 20), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def _load(self):
+        """Load results from the checkpoint file
+        Return False if its last line is truncated"""
+        with open(self.filename) as fdesc:
+            lines = fdesc.read().split("\n")
+
+        if json.loads(lines[0]) != self.run_info:
+            raise ValueError("Checkpoint %s comes from another run (binary, "
+                             "ABI or tests differ)" % self.filename)
+
+        for line in lines[1:]:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                # Empty or truncated line, on interruption
+                continue
+            self.results[result["address"]] = result
+        return lines[-1] == ""
+
+    def _write(self, obj):
+        self.fdesc.write(json.dumps(obj) + "\n")
+        self.fdesc.flush()
+
+    def add(self, address, functions, error, elapsed):
+        """Append the result of @address"""
+        result = {"address": address,
+                  "functions": functions,
+                  "error": error,
+                  "elapsed": elapsed}
+        self.results[address] = result
+        self._write(result)
+
+    def close(self):
+        self.fdesc.close()
@@ -1,5 +1,7 @@
 """Common / shared elements"""
+import struct
 import logging
+from functools import lru_cache
 try:
     import pycparser
 except ImportError:
@@ -27,6 +29,45 @@ class TimeoutException(Exception):
 
 END_ADDR = 0x1337babe
 
+# struct format of unsigned integers, by size in bits
+INT_FORMATS = {8: "B", 16: "H", 32: "I", 64: "Q"}
+
+
+def endianness(ira):
+    """Return the endianness ("little" or "big") of the architecture of the
+    lifter @ira"""
+    return "big" if ira.attrib == "b" else "little"
+
+
+@lru_cache(maxsize=None)
+def int_struct(size, byteorder):
+    """Return a struct.Struct for unsigned integers of @size bits, in
+    @byteorder ("little" or "big"), or None if there is no such format"""
+    if size not in INT_FORMATS:
+        return None
+    return struct.Struct(("<" if byteorder == "little" else ">") +
+                         INT_FORMATS[size])
+
+
+def pack_int(value, size, byteorder="little"):
+    """Return the @size bits unsigned integer @value as bytes, in @byteorder
+    Raise a ValueError if it does not fit"""
+    packer = int_struct(size, byteorder)
+    try:
+        if packer is None:
+            return value.to_bytes(size // 8, byteorder)
+        return packer.pack(value)
+    except (struct.error, OverflowError):
+        raise ValueError("To big to be packed")
+
+
+def unpack_int(data, byteorder="little"):
+    """Return the unsigned integer stored in @data, in @byteorder"""
+    packer = int_struct(len(data) * 8, byteorder)
+    if packer is None:
+        return int.from_bytes(data, byteorder)
+    return packer.unpack(data)[0]
+
 def print_table(ligs, title=True, separator='|', level=0, align=""):
     "Print nicely @ligs. If title, @ligs[0] is title ligne"
     # Calc max by col
@@ -36,6 +36,8 @@ default_config = {
     "idaq64_path": "",
     "ghidra_headless_path": "",
     "ghidra_export_function": "$SIBYL/ext/ghidra/ExportFunction.java",
+    "cache_path": "~/.cache/sibyl",
+    "cache_max_entries": 100000,
 }
 
 config_paths = [os.path.join(path, 'sibyl.conf')
@@ -166,6 +168,18 @@ class Config(object):
             if cparser.has_option("ghidra", "export_function"):
                 self.config["ghidra_export_function"] = cparser.get("ghidra", "export_function")
 
+        # Cache
+        #
+        # [cache]
+        if cparser.has_section("cache"):
+            # path = /path/to/cache/directory
+            if cparser.has_option("cache", "path"):
+                self.config["cache_path"] = cparser.get("cache", "path")
+            # max_entries = 100000
+            if cparser.has_option("cache", "max_entries"):
+                self.config["cache_max_entries"] = cparser.getint("cache",
+                                                                  "max_entries")
+
     def dump(self):
         """Dump the current configuration as a config file"""
         out = []
@@ -210,6 +224,12 @@ class Config(object):
         out.append("headless = %s" % self.config["ghidra_headless_path"])
         out.append("export_function = %s" % self.config["ghidra_export_function"])
 
+        # Cache
+        out.append("")
+        out.append("[cache]")
+        out.append("path = %s" % self.config["cache_path"])
+        out.append("max_entries = %d" % self.config["cache_max_entries"])
+
         return out
 
     @property
@@ -365,5 +385,16 @@ class Config(object):
         """
         return self.expandpath(self.config["ghidra_export_function"])
 
+    @property
+    def cache_path(self):
+        """Directory of the persistent results cache (empty to disable it)"""
+        path = self.config["cache_path"]
+        return self.expandpath(path) if path else ""
+
+    @property
+    def cache_max_entries(self):
+        """Maximum number of results kept in the cache"""
+        return self.config["cache_max_entries"]
+
 
 config = Config(default_config, config_paths)
@@ -1,3 +1,4 @@
+from sibyl.engine.snapshot import MemorySnapshot
 from sibyl.commons import init_logger
 
 
@@ -8,19 +9,56 @@ class Engine(object):
         """Instanciate an Engine
         @machine: miasm2.analysis.machine:Machine instance"""
         self.logger = init_logger(self.__class__.__name__)
+        # Signature of the crash ending the last run, if known:
+        # (kind, PC, faulting address)
+        self.crash = None
+        # Maximum number of instructions executed by a run, if any. Runs are
+        # bounded by it, in addition to their timeout if not null
+        self.budget = None
+        # Set if the last run has been stopped on exhausting its budget
+        self.exhausted = False
+        # If set, count the instructions executed by the next runs
+        self.measure = False
+        # Number of instructions executed by the last run, if counted
+        self.executed = None
 
-    def take_snapshot(self):
-        self.vm_mem = self.jitter.vm.get_all_memory()
+    def take_snapshot(self, directory=None):
+        """Snapshot the current VM state
+        @directory: (optional) directory used to share the memory snapshot
+        between processes"""
+        self.vm_mem = MemorySnapshot(self.jitter.vm.get_all_memory(),
+                                     directory=directory)
         self.vm_regs = self.jitter.cpu.get_gpreg()
 
     def restore_snapshot(self, memory=True):
         raise NotImplementedError("Abstract method")
 
     def run(self, address, timeout_seconds):
+        """Run the code at @address until it returns, or @timeout_seconds
+        seconds (0 for no limit)
+        Return False if it crashed or has been stopped, on timeout (or budget
+        exhaustion, if `budget` is set)"""
         raise NotImplementedError("Abstract method")
 
     def prepare_run(self):
         pass
 
+    def map_pages(self, pages, image):
+        """Map memory @pages, a list of (address, access, content)
+        @image: (address, content) covering all @pages, the space between
+        them being filled with zeros. It can be mapped instead of @pages by
+        engines ignoring access rights"""
+        for addr, access, content in pages:
+            self.jitter.vm.add_memory_page(addr, access, content)
+
+    def save_state(self):
+        """Return the current VM state, to be restored with `restore_state`
+        until the next snapshot restoration, or None if unsupported"""
+        return None
+
+    def restore_state(self, state):
+        """Restore the VM @state, as returned by `save_state`"""
+        raise NotImplementedError("Abstract method")
+
     def restore_snapshot(self, memory=True):
         raise NotImplementedError("Abstract method")
@@ -1,21 +1,51 @@
 import signal
+from bisect import bisect_right
+
+from miasm.core.interval import interval
+from miasm.jitter.csts import BREAKPOINT_WRITE, EXCEPT_BREAKPOINT_MEMORY, \
+    EXCEPT_CODE_AUTOMOD
 
 from sibyl.engine.engine import Engine
 from sibyl.commons import TimeoutException, END_ADDR
 
 
 class MiasmEngine(Engine):
-    """Engine based on Miasm"""
+    """Engine based on Miasm
+
+    Miasm jitters do not count instructions: the `budget`, and the `executed`
+    count, are numbers of executed basic blocks. They are counted on runs with
+    a budget only.
+    """
 
-    def __init__(self, machine, jit_engine):
+    # Maximum number of blocks executed between two budget checks
+    BUDGET_STEP = 1000
+
+    def __init__(self, machine, jit_engine, copy_on_write=True):
+        """Instanciate a MiasmEngine
+        @machine: miasm2.analysis.machine:Machine instance
+        @jit_engine: Miasm jitter name
+        @copy_on_write: if set, only restore pages modified since the last
+        snapshot restoration instead of the whole memory"""
         jitter = machine.jitter(jit_engine)
         jitter.set_breakpoint(END_ADDR, MiasmEngine._code_sentinelle)
         self.jitter = jitter
+        self.copy_on_write = copy_on_write
+
+        # The Python jitter runs one block per step
+        self._budget_step = 1 if jit_engine == "python" else self.BUDGET_STEP
+        # Blocks executed by the current run (lower bound), blocks allowed in
+        # its last step, and whether this step may have been interrupted
+        self._executed = 0
+        self._step = 0
+        self._interrupted = False
 
         # Signal handling
         #
         # Due to Python signal handling implementation, signals aren't handled
         # nor passed to Jitted code in case of registration with signal API
+        #
+        # In both cases, SIGALRM is raised by an interval timer, allowing
+        # timeouts below one second
         if jit_engine == "python":
             signal.signal(signal.SIGALRM, MiasmEngine._timeout)
         elif jit_engine in ["llvm", "tcc", "gcc"]:
@@ -36,11 +66,50 @@ class MiasmEngine(Engine):
     def _timeout(signum, frame):
         raise TimeoutException()
 
+    def _count_blocks(self, jitter):
+        """Callback called before each jitter step: account for the blocks
+        executed by the previous one, and stop once the budget is exhausted
+
+        A step runs up to `max_exec_per_call` blocks, but also stops before a
+        block not jitted yet, or on an exception or a breakpoint. In these
+        cases, only one block is counted, so that the count never exceeds the
+        number of executed blocks"""
+        if (self._interrupted or
+                jitter.pc not in jitter.jit.offset_to_jitted_func or
+                jitter.pc in jitter.breakpoints_handler.callbacks):
+            self._executed += min(self._step, 1)
+        else:
+            self._executed += self._step
+        self._interrupted = False
+        if jitter.pc == END_ADDR:
+            return True
+
+        remaining = self.budget - self._executed
+        if remaining <= 0:
+            self.exhausted = True
+            raise TimeoutException()
+        self._step = min(self._budget_step, remaining)
+        jitter.jit.options["max_exec_per_call"] = self._step
+        return True
+
     def run(self, address, timeout_seconds):
+        if self.copy_on_write:
+            # Account for writes done before the run (arguments, stack, ...)
+            self._track_written()
+
         self.jitter.init_run(address)
 
+        self.exhausted = False
+        if self.budget is None:
+            self.jitter.exec_cb = None
+            self.jitter.jit.options["max_exec_per_call"] = 0
+        else:
+            self.jitter.exec_cb = self._count_blocks
+            self._executed = self._step = 0
+            self._interrupted = False
+
         try:
-            signal.alarm(timeout_seconds)
+            signal.setitimer(signal.ITIMER_REAL, timeout_seconds)
             self.jitter.continue_run()
         except (AssertionError, RuntimeError, ValueError,
                 KeyError, IndexError, TimeoutException) as _:
@@ -49,19 +118,160 @@ class MiasmEngine(Engine):
             self.logger.exception(error)
             return False
         finally:
-            signal.alarm(0)
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            self.executed = None if self.budget is None else self._executed
 
         return True
 
+    def take_snapshot(self, directory=None):
+        super(MiasmEngine, self).take_snapshot(directory=directory)
+        if not self.copy_on_write:
+            return
+
+        # Snapshot pages, sorted by address
+        self._snap_addrs = sorted(self.vm_mem)
+        # Chunks written since the last restore:
+        # chunk start -> (chunk stop, snapshot page address)
+        self._dirty = {}
+        # Clean intervals, watched by a write breakpoint: start -> stop
+        self._clean = {}
+        self._clean_addrs = []
+        for addr in self._snap_addrs:
+            self._watch(addr, addr + self.vm_mem[addr]["size"])
+
+        self.jitter.add_exception_handler(EXCEPT_BREAKPOINT_MEMORY,
+                                          self._on_write)
+        self.jitter.exceptions_handler.set_callback(EXCEPT_CODE_AUTOMOD,
+                                                    self._on_automod)
+        self.jitter.vm.reset_memory_access()
+
+    def _watch(self, start, stop):
+        """Add a write breakpoint on the clean interval [@start, @stop["""
+        if start >= stop:
+            return
+        self.jitter.vm.add_memory_breakpoint(start, stop - start,
+                                             BREAKPOINT_WRITE)
+        self._clean[start] = stop
+        self._clean_addrs.insert(bisect_right(self._clean_addrs, start), start)
+
+    def _unwatch(self, start):
+        """Remove the write breakpoint on the clean interval starting at
+        @start"""
+        self.jitter.vm.remove_memory_breakpoint(start, BREAKPOINT_WRITE)
+        del self._clean[start]
+        self._clean_addrs.pop(bisect_right(self._clean_addrs, start) - 1)
+
+    def _snapshot_chunks(self, start, stop):
+        """Iterate on (chunk_start, chunk_stop, snapshot page address) for
+        chunks of snapshot pages intersecting [@start, @stop[. Chunks are
+        snapshot pages split on 0x1000 boundaries"""
+        index = max(bisect_right(self._snap_addrs, start) - 1, 0)
+        for snap_addr in self._snap_addrs[index:]:
+            if snap_addr >= stop:
+                break
+            snap_stop = snap_addr + self.vm_mem[snap_addr]["size"]
+            page = max(start, snap_addr) & ~0xfff
+            while page < min(stop, snap_stop):
+                yield (max(page, snap_addr), min(page + 0x1000, snap_stop),
+                       snap_addr)
+                page += 0x1000
+
+    def _track_written(self, written=None):
+        """Mark as dirty chunks written since the last call
+        @written: (optional) written intervals, if already fetched"""
+        if written is None:
+            written = self.jitter.vm.get_memory_write()
+        for start, stop in written:
+            for chunk_start, chunk_stop, snap_addr in self._snapshot_chunks(
+                    start, max(stop, start + 1)):
+                if chunk_start in self._dirty:
+                    continue
+                self._dirty[chunk_start] = (chunk_stop, snap_addr)
+
+                # Split the clean interval containing the chunk, so that next
+                # writes on this chunk are not trapped
+                index = bisect_right(self._clean_addrs, chunk_start) - 1
+                if index < 0:
+                    continue
+                clean_start = self._clean_addrs[index]
+                clean_stop = self._clean[clean_start]
+                if chunk_start >= clean_stop:
+                    continue
+                self._unwatch(clean_start)
+                self._watch(clean_start, chunk_start)
+                self._watch(chunk_stop, clean_stop)
+        self.jitter.vm.reset_memory_access()
+
+    def _on_write(self, jitter):
+        """Exception handler called on the first write to a clean interval"""
+        self._interrupted = True
+        self._track_written()
+        jitter.vm.set_exception(jitter.vm.get_exception() &
+                                ~EXCEPT_BREAKPOINT_MEMORY)
+        return True
+
+    def _on_automod(self, jitter):
+        """Exception handler called on writes to jitted code, replacing the
+        Miasm one which drops the modified blocks but also forgets the writes
+        before they are tracked"""
+        written = jitter.vm.get_memory_write()
+        self._interrupted = True
+        self._track_written(written)
+        jitter.jit.updt_automod_code_range(jitter.vm, written)
+        jitter.vm.set_exception(0)
+        return True
+
+    def _restore_dirty(self):
+        """Restore only dirty chunks, and remove pages added since the
+        snapshot"""
+        vm = self.jitter.vm
+        self._track_written()
+
+        for addr in vm.get_all_memory():
+            if addr not in self.vm_mem:
+                vm.remove_memory_page(addr)
+
+        rewritten = []
+        for chunk_start, (chunk_stop, snap_addr) in self._dirty.items():
+            offset = chunk_start - snap_addr
+            vm.set_mem(chunk_start, bytes(self.vm_mem[snap_addr]["data"][
+                offset:offset + chunk_stop - chunk_start]))
+            rewritten.append((chunk_start, chunk_stop - 1))
+
+            # Watch the chunk again, merging with adjacent clean intervals
+            if chunk_stop in self._clean:
+                clean_stop = self._clean[chunk_stop]
+                self._unwatch(chunk_stop)
+                chunk_stop = clean_stop
+            index = bisect_right(self._clean_addrs, chunk_start) - 1
+            if index >= 0:
+                clean_start = self._clean_addrs[index]
+                if self._clean[clean_start] == chunk_start:
+                    self._unwatch(clean_start)
+                    chunk_start = clean_start
+            self._watch(chunk_start, chunk_stop)
+
+        # Self-modifying code: drop blocks jitted from the code run, and
+        # rebuild the code blocks pool
+        code = self.jitter.jit.blocks_mem_interval & interval(rewritten)
+        if not code.empty:
+            self.jitter.jit.updt_automod_code_range(vm, list(code))
+
+        self._dirty.clear()
+        vm.reset_memory_access()
+
     def restore_snapshot(self, memory=True):
         # Restore memory
         if memory:
-            self.jitter.vm.reset_memory_page_pool()
-            self.jitter.vm.reset_code_bloc_pool()
-            for addr, metadata in self.vm_mem.items():
-                self.jitter.vm.add_memory_page(addr,
-                                               metadata["access"],
-                                               metadata["data"])
+            if self.copy_on_write:
+                self._restore_dirty()
+            else:
+                self.jitter.vm.reset_memory_page_pool()
+                self.jitter.vm.reset_code_bloc_pool()
+                for addr, metadata in self.vm_mem.items():
+                    self.jitter.vm.add_memory_page(addr,
+                                                   metadata["access"],
+                                                   bytes(metadata["data"]))
 
         # Restore registers
         self.jitter.cpu.init_regs()
@@ -1,8 +1,10 @@
 import math
+from bisect import bisect_right
 
 # from capstone import *
 
 from miasm.core.utils import pck32, pck64
+from miasm.core.bin_stream import bin_stream_str
 from miasm.core.locationdb import LocationDB
 from miasm.jitter.csts import PAGE_READ, PAGE_WRITE
 try:
@@ -11,7 +13,7 @@ except ImportError:
     unicorn = None
 
 from sibyl.engine.engine import Engine
-from sibyl.commons import END_ADDR, init_logger
+from sibyl.commons import END_ADDR, init_logger, endianness, pack_int
 
 
 class UnexpectedStopException(Exception):
@@ -29,30 +31,63 @@ class QEMUEngine(Engine):
         self.jitter = UcWrapJitter(machine)
         super(QEMUEngine, self).__init__(machine)
 
+    def take_snapshot(self, directory=None):
+        super(QEMUEngine, self).take_snapshot(directory=directory)
+        self.vm_context = self.jitter.cpu.get_context()
+        # Memory is now in sync with the snapshot
+        self.jitter.vm.clear_dirty_pages()
+
     def run(self, address, timeout_seconds):
         # print(f'!!! [qemu.QEMUEngine.run] address={address:#x} timeout={timeout_seconds}s')
+        self.crash = self.jitter.crash = None
+        self.exhausted = False
+        self.executed = None
+        counter = None
+        if self.measure:
+            # Hooking each block slows the emulation down: only count on
+            # request
+            self.jitter.executed = 0
+            counter = self.jitter.mu.hook_add(unicorn.UC_HOOK_BLOCK,
+                                              self.jitter.hook_count)
         try:
-            self.jitter.run(address, timeout_seconds)
+            self.jitter.run(address, timeout_seconds, count=self.budget or 0)
         except UnexpectedStopException:
+            self.crash = self.jitter.crash
+            self.exhausted = (self.budget is not None and
+                              self.jitter.interrupted)
             return False
         except Exception as error:
             self.logger.exception(error)
             return False
+        finally:
+            if counter is not None:
+                self.jitter.mu.hook_del(counter)
+                self.executed = self.jitter.executed
 
         return True
 
-    def prepare_run(self):
-        # XXX HACK: Avoid a slow down of unicorn (apparently to too many
-        # threads...)
-        self.jitter.renew()
-
     def restore_snapshot(self, memory=True):
         # Restore VM
         if memory:
             self.jitter.vm.restore_mem_state(self.vm_mem)
 
         # Restore registers
-        self.jitter.cpu.set_gpreg(self.vm_regs)
+        self.jitter.cpu.set_context(self.vm_context)
+
+    def map_pages(self, pages, image):
+        if image is None:
+            return
+        # Access rights are not enforced: map all pages at once
+        addr, content = image
+        self.jitter.vm.add_memory_page(addr, PAGE_READ | PAGE_WRITE, content)
+
+    def save_state(self):
+        return self.jitter.vm.get_mem_delta(), self.jitter.cpu.get_context()
+
+    def restore_state(self, state):
+        delta, context = state
+        self.jitter.vm.restore_mem_delta(self.vm_mem, delta)
+        self.jitter.cpu.set_context(context)
 
 
 class UcWrapJitter(object):
@@ -63,6 +98,12 @@ class UcWrapJitter(object):
         self.renew()
 
     def renew(self):
+        """Create the unicorn instance
+
+        The instance is then kept for all the tested functions, the snapshot
+        restoration being enough to reset it. It used to be renewed for each
+        function to avoid a slow down due to unicorn releases older than 1.0,
+        which did not join the timeout thread started by each `emu_start`"""
         ask_arch, ask_attrib = self.ira.arch.name, self.ira.attrib
         cpucls = UcWrapCPU.available_cpus.get((ask_arch, ask_attrib), None)
         # print('!!! [qemu.UcWrapJitter.renew] {}'.format(UcWrapCPU.available_cpus))
@@ -73,9 +114,19 @@ class UcWrapJitter(object):
         self.ask_attrib = ask_attrib
 
         self.mu = unicorn.Uc(arch, mode)
-        self.vm = UcWrapVM(self.mu)
+        self.vm = UcWrapVM(self.mu, endianness(self.ira))
         self.cpu = cpucls(self.mu)
 
+        # Stop on the first invalid access or instruction, recording its
+        # signature. These hooks are only called on faults
+        self.crash = None
+        # Set if the last run stopped on timeout or instruction count
+        self.interrupted = False
+        # (block address, size) -> number of instructions, see `hook_count`
+        self.block_lengths = {}
+        self.mu.hook_add(unicorn.UC_HOOK_MEM_UNMAPPED, self.hook_mem_unmapped)
+        self.mu.hook_add(unicorn.UC_HOOK_INSN_INVALID, self.hook_insn_invalid)
+
     def init_stack(self):
         self.vm.add_memory_page(0x1230000, PAGE_WRITE | PAGE_READ,
                                 b"\x00" * 0x10000, "Stack")
@@ -91,18 +142,29 @@ class UcWrapJitter(object):
                 getattr(self.cpu, self.ira.sp.name) - self.ira.sp.size // 8)
         self.vm.set_mem(getattr(self.cpu, self.ira.sp.name), pck64(value))
 
-    def run(self, pc, timeout_seconds=1):
+    def run(self, pc, timeout_seconds=1, count=0):
+        """Run from @pc until END_ADDR is reached
+        Stop after @timeout_seconds seconds and, if @count is set, @count
+        instructions (0 for no limit). In this case, `interrupted` is set
+
+        Raise an UnexpectedStopException if END_ADDR is not reached"""
         # checking which instruction you want to emulate: THUMB/THUMB2 or others
         # Note we start at ADDRESS | 1 to indicate THUMB mode.
 
         # print(f'!!! [qemu.UcWrapJitter.run] {self.ask_arch}:{self.ask_attrib}'
         #       f' pc={pc:#x} end={END_ADDR:#x} timeout={timeout_seconds}s')
+        self.interrupted = False
         try:
             timeout = int(timeout_seconds * unicorn.UC_SECOND_SCALE)
             if self.ask_arch == 'armt' and self.ask_attrib == 'l':
-                self.mu.emu_start(pc | 1, END_ADDR, timeout)
+                self.mu.emu_start(pc | 1, END_ADDR, timeout, count)
             else:
-                self.mu.emu_start(pc, END_ADDR, timeout)
+                self.mu.emu_start(pc, END_ADDR, timeout, count)
+            if getattr(self.cpu, self.ira.pc.name) != END_ADDR:
+                # Stopped on timeout or instruction count, faults raising an
+                # UcError
+                self.interrupted = True
+                raise UnexpectedStopException()
             # print('!!! [qemu.UcWrapJitter.run] OK')
             # code = self.mu.mem_read(pc, 96)
             # print(f'!!! [qemu.UcWrapJitter.run] code: {code.hex()}')
@@ -128,6 +190,48 @@ class UcWrapJitter(object):
         finally:
             self.mu.emu_stop()
 
+    # Unicorn memory access type -> crash kind
+    crash_kinds = {}
+    if unicorn:
+        crash_kinds = {unicorn.UC_MEM_READ_UNMAPPED: "read",
+                       unicorn.UC_MEM_WRITE_UNMAPPED: "write",
+                       unicorn.UC_MEM_FETCH_UNMAPPED: "fetch"}
+
+    def hook_mem_unmapped(self, uc, access, address, size, value, user_data):
+        """Record the signature of an access to unmapped memory, and stop"""
+        pc = getattr(self.cpu, self.ira.pc.name)
+        self.crash = (self.crash_kinds.get(access, "unmapped"), pc, address)
+        return False
+
+    def hook_count(self, uc, address, size, user_data):
+        """Count executed instructions, block by block"""
+        length = self.block_lengths.get((address, size))
+        if length is None:
+            length = self.block_length(address, size)
+            self.block_lengths[(address, size)] = length
+        self.executed += length
+
+    def block_length(self, address, size):
+        """Return the number of instructions in the @size bytes block at
+        @address"""
+        data = bin_stream_str(bytes(self.mu.mem_read(address, size)))
+        length = offset = 0
+        while offset < size:
+            length += 1
+            try:
+                instr = self.ira.arch.dis(data, self.ira.attrib, offset)
+            except Exception:
+                # Count the remaining bytes as a single instruction
+                break
+            offset += instr.l
+        return length
+
+    def hook_insn_invalid(self, uc, user_data):
+        """Record the signature of an invalid instruction, and stop"""
+        pc = getattr(self.cpu, self.ira.pc.name)
+        self.crash = ("instruction", pc, pc)
+        return False
+
     def verbose_mode(self):
         self.mu.hook_add(unicorn.UC_HOOK_MEM_READ_UNMAPPED, self.hook_mem_invalid)
         self.mu.hook_add(unicorn.UC_HOOK_CODE, self.hook_code)
@@ -145,9 +249,69 @@ class UcWrapJitter(object):
 
 class UcWrapVM(object):
 
-    def __init__(self, mu):
+    # Access rights of pages not written since the last restore
+    clean_prot = None
+    if unicorn:
+        clean_prot = unicorn.UC_PROT_READ | unicorn.UC_PROT_EXEC
+
+    def __init__(self, mu, byteorder="little"):
+        # Mapped pages, sorted by address, and their start addresses
         self.mem_page = []
+        self.page_addrs = []
+        # Pages mapped through add_memory_page since the last restore
+        self.new_pages = []
         self.mu = mu
+        self.byteorder = byteorder
+
+        # Pages (0x1000 aligned) written since the last restore. Other pages
+        # are write-protected: the first write of the emulated code to each
+        # of them is caught by `hook_mem_write_prot`
+        self.dirty_pages = set()
+        self.mu.hook_add(unicorn.UC_HOOK_MEM_WRITE_PROT,
+                         self.hook_mem_write_prot)
+
+    def hook_mem_write_prot(self, uc, access, address, size, value,
+                            user_data):
+        """Track a page written by the emulated code for the first time since
+        the last restore, restore its write access and complete the write"""
+        for page_addr in set([address & ~0xfff,
+                              (address + size - 1) & ~0xfff]):
+            if self.get_page(page_addr) is None:
+                return False
+            self.dirty_pages.add(page_addr)
+            self.mu.mem_protect(page_addr, 0x1000, unicorn.UC_PROT_ALL)
+        # The faulting write is not replayed
+        self.mu.mem_write(address, pack_int(value & ((1 << (size * 8)) - 1),
+                                            size * 8, self.byteorder))
+        return True
+
+    def protect_pages(self, page_addrs):
+        """Write-protect the pages at @page_addrs, not written anymore"""
+        for page_addr in page_addrs:
+            if self.get_page(page_addr) is not None:
+                self.mu.mem_protect(page_addr, 0x1000, self.clean_prot)
+
+    def clear_dirty_pages(self):
+        """Consider the whole memory as not written, ie. in sync with the
+        snapshot"""
+        for page in self.mem_page:
+            self.mu.mem_protect(page["addr"], page["size"], self.clean_prot)
+        self.dirty_pages.clear()
+
+    def get_page(self, addr):
+        """Return the index of the page containing @addr, or None"""
+        index = bisect_right(self.page_addrs, addr) - 1
+        if index < 0:
+            return None
+        page = self.mem_page[index]
+        if addr >= page["addr"] + page["size"]:
+            return None
+        return index
+
+    def _insert_page(self, page):
+        index = bisect_right(self.page_addrs, page["addr"])
+        self.page_addrs.insert(index, page["addr"])
+        self.mem_page.insert(index, page)
 
     def add_memory_page(self, addr, access, item_str, name=""):
         size = len(item_str)
@@ -156,16 +320,16 @@ class UcWrapVM(object):
         # print(f'!!! [qemu.UcWrapVM.add_memory_page] {addr:#x} {access} {item_str[:16].hex()}...'
         #       f' "{name}" {size:#x}')
 
-        for page in self.mem_page:
-            if page["addr"] <= addr < page["addr"] + page["size"]:
-                self.set_mem(addr, item_str)
-                return
+        if self.get_page(addr) is not None:
+            self.set_mem(addr, item_str)
+            return
 
-        self.mem_page.append({"addr": addr,
-                              "size": size,
-                              "name": name,
-                              "access": access,
-                              })
+        self._insert_page({"addr": addr,
+                           "size": size,
+                           "name": name,
+                           "access": access,
+                           })
+        self.new_pages.append(addr)
 
         self.mu.mem_map(addr, size)
         self.set_mem(addr, item_str)
@@ -175,6 +339,8 @@ class UcWrapVM(object):
 
     def set_mem(self, addr, content):
         self.mu.mem_write(addr, content)
+        for page_addr in range(addr & ~0xfff, addr + len(content), 0x1000):
+            self.dirty_pages.add(page_addr)
 
     def get_all_memory(self):
         dico = {}
@@ -187,42 +353,103 @@ class UcWrapVM(object):
         return dico
 
     def is_mapped(self, address, size):
-        for addr in range(address, address + size):
-            for page in self.mem_page:
-                if page["addr"] <= addr < page["addr"] + page["size"]:
-                    break
-            else:
+        index = self.get_page(address)
+        if index is None:
+            return False
+
+        # Walk through contiguous pages until the end of the range
+        end = address + size
+        page = self.mem_page[index]
+        while page["addr"] + page["size"] < end:
+            index += 1
+            if index == len(self.mem_page):
                 return False
+            next_page = self.mem_page[index]
+            if next_page["addr"] != page["addr"] + page["size"]:
+                return False
+            page = next_page
         return True
 
+    def _remove_new_pages(self, mem_state, keep=()):
+        """Unmap pages added since the last restore, except those in
+        @mem_state or @keep"""
+        for addr in self.new_pages:
+            if addr in mem_state or addr in keep:
+                continue
+            index = bisect_right(self.page_addrs, addr) - 1
+            page = self.mem_page.pop(index)
+            del self.page_addrs[index]
+            self.mu.mem_unmap(page["addr"], page["size"])
+
+    def get_mem_delta(self):
+        """Return the difference between the current memory and the state it
+        has been restored from: (pages added, {written page address: content})
+        """
+        added = [dict(self.mem_page[self.get_page(addr)])
+                 for addr in self.new_pages]
+        written = {}
+        for dirty_addr in self.dirty_pages:
+            if self.get_page(dirty_addr) is not None:
+                written[dirty_addr] = self.get_mem(dirty_addr, 0x1000)
+        return added, written
+
+    def restore_mem_delta(self, mem_state, delta):
+        """Restore the memory state to @mem_state modified by @delta, as
+        returned by `get_mem_delta`. Only pages written since the last
+        restore are rewritten"""
+        added, written = delta
+        added_addrs = [page["addr"] for page in added]
+        self._remove_new_pages(mem_state, added_addrs)
+        self.new_pages = added_addrs
+
+        for dirty_addr in self.dirty_pages:
+            if dirty_addr in written:
+                self.mu.mem_write(dirty_addr, written[dirty_addr])
+                continue
+            index = self.get_page(dirty_addr)
+            if index is None:
+                continue
+            page = self.mem_page[index]
+            offset = dirty_addr - page["addr"]
+            if page["addr"] in mem_state:
+                data = mem_state[page["addr"]]["data"]
+                self.mu.mem_write(dirty_addr,
+                                  bytes(data[offset:offset + 0x1000]))
+            else:
+                # Page added by the delta, never written
+                self.mu.mem_write(dirty_addr, b"\x00" * min(
+                    0x1000, page["size"] - offset))
+
+        # Pages of the delta differ from @mem_state
+        self.protect_pages(self.dirty_pages.difference(written))
+        self.dirty_pages = set(written)
+
     def restore_mem_state(self, mem_state):
         """Restore the memory state according to mem_state
-        Optimisation: only consider memory unwrittable"""
-        new_mem_page = []
-        addrs = set()
+        Optimisation: only rewrite pages written since the last restore"""
+
+        # Remove additionnal pages
+        self._remove_new_pages(mem_state)
+        self.new_pages = []
+
+        # Rewrite dirty pages content
+        for dirty_addr in self.dirty_pages:
+            index = self.get_page(dirty_addr)
+            if index is None:
+                continue
+            page = self.mem_page[index]
+            offset = dirty_addr - page["addr"]
+            data = mem_state[page["addr"]]["data"]
+            self.mu.mem_write(dirty_addr, bytes(data[offset:offset + 0x1000]))
+        self.protect_pages(self.dirty_pages)
+
+        # Add missing pages, if any. Remaining pages are part of mem_state
+        if len(self.mem_page) < len(mem_state):
+            for addr, page in mem_state.items():
+
+                if self.get_page(addr) is not None:
+                    continue
 
-        for page in self.mem_page:
-            if page["addr"] not in mem_state:
-                # Remove additionnal pages
-                self.mu.mem_unmap(page["addr"], page["size"])
-            else:
-                # Rewrite pages content
-                if page["access"] & PAGE_WRITE:
-                    self.set_mem(page["addr"], mem_state[page["addr"]]["data"])
-                new_mem_page.append(page)
-                addrs.add(page["addr"])
-
-        for addr, page in mem_state.items():
-
-            page_size = page['size']
-            frac, _n = math.modf(page_size // 1024)
-            # print(f'!!! [qemu.Uc.WrapVM.restore_mem_state] {addr:#x} {page["access"]}'
-            #       f' size={page_size:#x}')
-            # if frac > 0.0 or int(_n) % 2 == 1:
-            #     print(f'!!! [qemu.Uc.WrapVM.restore_mem_state] {frac} {_n}')
-
-            # Add missing pages
-            if addr not in addrs:
                 page_size = page['size']
                 frac, _n = math.modf(page_size // 1024)
                 if frac > 0.0:
@@ -234,13 +461,13 @@ class UcWrapVM(object):
                     page_size = n * 1024
 
                 # print('!!! [qemu.UcWrapVM.restore_mem_state] {addr:#x} size={page_size:#x}')
-                self.mu.mem_map(addr, page_size)
-                self.set_mem(addr, page["data"])
-                new_mem_page.append({"addr": addr,
-                                     "size": page_size,
-                                     "name": "",
-                                     "access": page["access"]})
-        self.mem_page = new_mem_page
+                self.mu.mem_map(addr, page_size, self.clean_prot)
+                self.mu.mem_write(addr, bytes(page["data"]))
+                self._insert_page({"addr": addr,
+                                   "size": page_size,
+                                   "name": "",
+                                   "access": page["access"]})
+        self.dirty_pages.clear()
 
 
 class UcWrapCPU(object):
@@ -292,6 +519,14 @@ class UcWrapCPU(object):
         for k, v in values.items():
             self.mu.reg_write(self.regs[k], v)
 
+    def get_context(self):
+        """Return an opaque copy of the whole CPU state"""
+        return self.mu.context_save()
+
+    def set_context(self, context):
+        """Restore the CPU state from @context, obtained with get_context"""
+        self.mu.context_restore(context)
+
     @classmethod
     def register(cls, arch, attrib):
         super(cls, cls).available_cpus[(arch, attrib)] = cls
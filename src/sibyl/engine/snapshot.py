@@ -0,0 +1,78 @@
+"""Memory snapshot, shared between processes"""
+
+import os
+import mmap
+import struct
+import hashlib
+from collections.abc import Mapping
+
+
+class MemorySnapshot(Mapping):
+    """Read-only memory state, with the same interface than the dictionary
+    returned by `get_all_memory`: address -> {"access", "size", "data"}
+
+    Pages content is stored in a single mmap, "data" being a zero-copy
+    memoryview on it. Pages are then materialized only when they are
+    restored. The mapping is shared with forked processes and, if a
+    @directory is provided, between processes taking a snapshot of the
+    same memory state.
+    """
+
+    def __init__(self, memory, directory=None):
+        """Init a snapshot from @memory
+        @memory: dictionary, as returned by `get_all_memory`
+        @directory: (optional) directory used to share the snapshot content
+        """
+        # address -> (access, offset, size)
+        self.pages = {}
+        offset = 0
+        for addr in sorted(memory):
+            size = len(memory[addr]["data"])
+            self.pages[addr] = (memory[addr]["access"], offset, size)
+            offset += size
+
+        if directory is None:
+            self.mmap = mmap.mmap(-1, max(offset, 1))
+            for addr, (_, page_offset, size) in self.pages.items():
+                self.mmap[page_offset:page_offset + size] = memory[addr]["data"]
+        else:
+            self.mmap = self._map_file(memory, directory)
+        self.view = memoryview(self.mmap)
+
+    def _map_file(self, memory, directory):
+        """Map the file in @directory associated to @memory, creating it if
+        needed"""
+        digest = hashlib.sha256()
+        for addr, (access, _, size) in sorted(self.pages.items()):
+            digest.update(struct.pack("<QQQ", addr, access, size))
+            digest.update(memory[addr]["data"])
+        path = os.path.join(directory, "snapshot-%s" % digest.hexdigest())
+
+        if not os.path.exists(path):
+            # Write then rename, as other processes may share the same path
+            tmp_path = "%s.%d" % (path, os.getpid())
+            with open(tmp_path, "wb") as fdesc:
+                for addr in sorted(self.pages):
+                    fdesc.write(memory[addr]["data"])
+                # Avoid an empty mapping
+                if not self.pages:
+                    fdesc.write(b"\x00")
+            os.rename(tmp_path, path)
+
+        with open(path, "rb") as fdesc:
+            return mmap.mmap(fdesc.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __getitem__(self, addr):
+        access, offset, size = self.pages[addr]
+        return {"access": access,
+                "size": size,
+                "data": self.view[offset:offset + size]}
+
+    def __contains__(self, addr):
+        return addr in self.pages
+
+    def __iter__(self):
+        return iter(self.pages)
+
+    def __len__(self):
+        return len(self.pages)
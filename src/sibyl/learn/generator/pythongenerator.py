@@ -29,7 +29,7 @@ for size in segSize:
     self.segBase{n}.append(self._reserv_mem(size))
 
 for ((offset, segment), value, accessRight) in allocList:
-    self.jitter.vm.add_memory_page(offset + self.segBase{n}[segment], accessRight, value)
+    self._add_page(offset + self.segBase{n}[segment], accessRight, value)
 '''
 refUpdateTemplate = '''
 # Reference update
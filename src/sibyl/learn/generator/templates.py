@@ -11,6 +11,7 @@ class Test{funcname}(TestHeader):
 """
 
 classAttrib = """    func = "{funcname}"
+    compile_inputs = True
     header = '''
 {header}
 '''
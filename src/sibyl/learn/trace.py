@@ -1,6 +1,6 @@
 from collections import namedtuple
-import struct
 
+from sibyl.commons import endianness, pack_int, unpack_int
 from sibyl.learn.replay import Replay
 from miasm2.jitter.csts import PAGE_READ, PAGE_WRITE
 from miasm2.core.graph import DiGraph
@@ -70,14 +70,13 @@ class MemoryAccess(object):
 
 class Snapshot(object):
 
-    @classmethod
-    def get_byte(cls, value, byte):
-        '''Return the byte @byte of the value'''
-        return struct.pack('@B', (value & (0xFF << (8 * byte))) >> (8 * byte))
+    def get_bytes(self, value, size):
+        '''Return the @size bytes @value, as stored in memory'''
+        return pack_int(value & ((1 << (8 * size)) - 1), 8 * size,
+                        self._endianness)
 
-    @classmethod
-    def unpack_ptr(cls, value):
-        return struct.unpack('@P', value)[0]
+    def unpack_ptr(self, value):
+        return unpack_int(value, self._endianness)
 
     def __init__(self, abicls, machine):
         self.abicls = abicls
@@ -99,6 +98,7 @@ class Snapshot(object):
         self._ira = Machine(machine).ira()
         self._ptr_size = self._ira.sizeof_pointer()/8
         self.sp = self._ira.sp.name
+        self._endianness = endianness(self._ira)
 
     def add_input_register(self, reg_name, reg_value):
         self.input_reg[reg_name] = reg_value
@@ -107,15 +107,16 @@ class Snapshot(object):
         self.output_reg[reg_name] = reg_value
 
     def add_memory_read(self, address, size, value):
+        data = self.get_bytes(value, size)
         for i in range(size):
             self.out_memory[address + i] = MemoryAccess(1,
-                                                        Snapshot.get_byte(value, i),
+                                                        data[i:i + 1],
                                                         0,  # Output access never used
             )
 
             if address + i not in self.in_memory:
                 self.in_memory[address + i] = MemoryAccess(1,
-                                                           Snapshot.get_byte(value, i),
+                                                           data[i:i + 1],
                                                            PAGE_READ,
                 )
 
@@ -123,9 +124,10 @@ class Snapshot(object):
                 self.in_memory[address + i].access |= PAGE_READ
 
     def add_memory_write(self, address, size, value):
+        data = self.get_bytes(value, size)
         for i in range(size):
             self.out_memory[address + i] = MemoryAccess(1,
-                                                        Snapshot.get_byte(value, i),
+                                                        data[i:i + 1],
                                                         0,  # Output access never used
             )
 
@@ -0,0 +1,81 @@
+"""Statistics on tests, used to schedule them"""
+
+from sibyl.cache import SQLiteStore
+
+
+class TestStats(SQLiteStore):
+    """Per test statistics, persisted between runs
+
+    For each test class (and each of its sub-tests), record:
+    - runs: number of launches
+    - rejects: number of launches ending in a failure
+    - first_rejects: number of failures on the first sub-test (classes only)
+    - time: total emulation time, in seconds
+
+    Statistics are loaded once, and new records are kept in memory until
+    `flush` is called.
+    """
+
+    filename = "stats.sqlite"
+    schema = ("CREATE TABLE IF NOT EXISTS stats ("
+              "test TEXT, "
+              "subtest TEXT, "
+              "runs INTEGER, "
+              "rejects INTEGER, "
+              "first_rejects INTEGER, "
+              "time REAL, "
+              "PRIMARY KEY (test, subtest))")
+
+    # Sub-test name used for the whole test class
+    ALL = ""
+
+    def __init__(self, directory):
+        super(TestStats, self).__init__(directory)
+        # (test, subtest) -> [runs, rejects, first_rejects, time]
+        self.stats = {}
+        self.pending = {}
+        for row in self.conn.execute("SELECT * FROM stats"):
+            self.stats[row[:2]] = list(row[2:])
+
+    def record(self, test, subtest, rejected, elapsed, first_reject=False):
+        """Record a launch of @subtest from @test"""
+        for stats in [self.stats, self.pending]:
+            entry = stats.setdefault((test, subtest), [0, 0, 0, 0.])
+            entry[0] += 1
+            entry[1] += int(rejected)
+            entry[2] += int(first_reject)
+            entry[3] += elapsed
+
+    def flush(self):
+        """Save pending records"""
+        if not self.pending:
+            return
+        with self.conn:
+            self.conn.execute("BEGIN")
+            for (test, subtest), (runs, rejects, first_rejects,
+                                  elapsed) in self.pending.items():
+                self.conn.execute("INSERT OR IGNORE INTO stats "
+                                  "VALUES (?, ?, 0, 0, 0, 0.)",
+                                  (test, subtest))
+                self.conn.execute("UPDATE stats SET runs = runs + ?, "
+                                  "rejects = rejects + ?, "
+                                  "first_rejects = first_rejects + ?, "
+                                  "time = time + ? "
+                                  "WHERE test = ? AND subtest = ?",
+                                  (runs, rejects, first_rejects, elapsed,
+                                   test, subtest))
+        self.pending.clear()
+
+    def get(self, test, subtest=ALL):
+        """Return (runs, rejects, first_rejects, time) for @subtest of @test"""
+        return tuple(self.stats.get((test, subtest), (0, 0, 0, 0.)))
+
+    def cost(self, test, subtest=ALL):
+        """Return the mean emulation time spent per rejection of @subtest of
+        @test, or None if unknown"""
+        runs, rejects, _, elapsed = self.get(test, subtest)
+        if not runs:
+            return None
+        if not rejects:
+            return float("inf")
+        return elapsed / rejects
@@ -40,6 +40,7 @@ class TestAbs(Test):
 
     # Properties
     func = "abs"
+    compile_inputs = True
     tests = TestSetTest(init1, check1) & TestSetTest(init2, check2)
 
 
@@ -60,6 +61,7 @@ class TestA64l(Test):
 
     # Properties
     func = "a64l"
+    compile_inputs = True
     tests = TestSetTest(init, check)
 
 
@@ -93,8 +95,14 @@ class TestAtoi(Test):
         return self.my_check(self.my_string2)
 
 
+    # Probe
+    def check_probe(self, probe):
+        return probe.result == 0 and probe.unchanged
+
     # Properties
     func = "atoi"
+    probe_returns = True
+    compile_inputs = True
     tests = TestSetTest(init1, check1) & TestSetTest(init2, check2)
 
 
@@ -50,8 +50,14 @@ class TestStrlen(Test):
 
         return self._ensure_mem(self.my_addr, self.my_string.encode('utf-8') * 4 + b"\x00")
 
+    # Probe
+    def check_probe(self, probe):
+        return probe.result == len(probe.string) and probe.unchanged
+
     # Properties
     func = "strlen"
+    probe_returns = True
+    compile_inputs = True
     tests = TestSetTest(init, check) & TestSetTest(init2, check2)
 
 
@@ -94,8 +100,14 @@ class TestStrnicmp(Test):
                     self._ensure_mem(self.my_addr1, self.my_string1.encode('utf-8')),
                     self._ensure_mem(self.my_addr2, self.my_string2.encode('utf-8'))])
 
+    # Probe
+    def check_probe(self, probe):
+        return probe.result == 0 and probe.unchanged
+
     # Properties
     func = "strnicmp"
+    probe_returns = True
+    compile_inputs = True
     tests = TestSetTest(init, check) & TestSetTest(init2, check2)
 
 
@@ -118,8 +130,14 @@ class TestStrcpy(Test):
                     self._ensure_mem(self.my_addr, self.my_string.encode('utf-8')),
                     self._ensure_mem(self.my_addr2, self.my_string.encode('utf-8'))])
 
+    # Probe
+    def check_probe(self, probe):
+        return probe.result == probe.my_addr1 and probe.unchanged
+
     # Properties
     func = "strcpy"
+    probe_returns = True
+    compile_inputs = True
     tests = TestSetTest(init, check)
 
 
@@ -165,8 +183,14 @@ class TestStrncpy(Test):
         return self.my_check(self.my_string2, self.real_size,
                              self.real_size + 10)
 
+    # Probe
+    def check_probe(self, probe):
+        return probe.result == probe.my_addr1 and probe.unchanged
+
     # Properties
     func = "strncpy"
+    probe_returns = True
+    compile_inputs = True
     tests = TestSetTest(init, check) & TestSetTest(init2, check2)
 
 
@@ -195,8 +219,14 @@ class TestStrcat(Test):
                                      self.my_string2.encode('utf-8')),
                     self._ensure_mem(self.my_addr2, self.my_string2.encode('utf-8'))])
 
+    # Probe
+    def check_probe(self, probe):
+        return probe.result == probe.my_addr1
+
     # Properties
     func = "strcat"
+    probe_returns = True
+    compile_inputs = True
     tests = TestSetTest(init, check)
 
 
@@ -225,8 +255,14 @@ class TestStrncat(Test):
                                      concated.encode('utf-8')),
                     self._ensure_mem(self.my_addr2, self.my_string2.encode('utf-8'))])
 
+    # Probe
+    def check_probe(self, probe):
+        return probe.result == probe.my_addr1
+
     # Properties
     func = "strncat"
+    probe_returns = True
+    compile_inputs = True
     tests = TestSetTest(init, check)
 
 
@@ -306,8 +342,14 @@ class TestStrcmp(Test):
         return self.my_check(self.my_addr1, self.my_addr3,
                              self.my_string1, self.my_string3)
 
+    # Probe
+    def check_probe(self, probe):
+        return self._to_int(probe.result) == 0 and probe.unchanged
+
     # Properties
     func = "strcmp"
+    probe_returns = True
+    compile_inputs = True
     tests = TestSetTest(init1, check1) & TestSetTest(init2, check2) & \
         TestSetTest(init3, check3) & TestSetTest(init4, check4)
 
@@ -409,8 +451,14 @@ class TestStrncmp(Test):
                              self.my_len,
                              self.my_string5, self.my_string6)
 
+    # Probe
+    def check_probe(self, probe):
+        return self._to_int(probe.result) == 0 and probe.unchanged
+
     # Properties
     func = "strncmp"
+    probe_returns = True
+    compile_inputs = True
     tests = TestSetTest(init1, check1) & TestSetTest(init2, check2) & \
         TestSetTest(init3, check3) & TestSetTest(init4, check4) & \
         TestSetTest(init5, check5)
@@ -488,8 +536,14 @@ class TestStricmp(Test):
         return self.my_check(self.my_addr1, self.my_addr3,
                              self.my_string1, self.my_string3)
 
+    # Probe
+    def check_probe(self, probe):
+        return self._to_int(probe.result) == 0 and probe.unchanged
+
     # Properties
     func = "stricmp"
+    probe_returns = True
+    compile_inputs = True
     tests = TestSetTest(init1, check1) & TestSetTest(init2, check2) & \
         TestSetTest(init3, check3) & TestSetTest(init4, check4)
 
@@ -527,6 +581,7 @@ class TestStrchr(Test):
 
     # Properties
     func = "strchr"
+    compile_inputs = True
     tests = TestSetTest(init1, check1) & TestSetTest(init2, check2)
 
 
@@ -562,6 +617,7 @@ class TestStrrchr(Test):
 
     # Properties
     func = "strrchr"
+    compile_inputs = True
     tests = TestSetTest(init1, check1) & TestSetTest(init2, check2)
 
 
@@ -599,8 +655,14 @@ class TestStrnlen(Test):
 
         return self._ensure_mem(self.my_addr, self.my_string.encode('utf-8') + b"\x00")
 
+    # Probe
+    def check_probe(self, probe):
+        return probe.result == len(probe.string) and probe.unchanged
+
     # Properties
     func = "strnlen"
+    probe_returns = True
+    compile_inputs = True
     tests = TestSetTest(init1, check1) & TestSetTest(init2, check2)
 
 
@@ -659,8 +721,14 @@ class TestStrspn(Test):
         return self.my_check(self.my_addr1, self.my_addr3,
                              self.my_string1, self.my_string3)
 
+    # Probe
+    def check_probe(self, probe):
+        return probe.result == len(probe.string) and probe.unchanged
+
     # Properties
     func = "strspn"
+    probe_returns = True
+    compile_inputs = True
     tests = TestSetTest(init1, check1) & TestSetTest(init2, check2) & TestSetTest(init3, check3)
 
 
@@ -722,8 +790,14 @@ class TestStrpbrk(Test):
         return self.my_check(self.my_addr1, self.my_addr3,
                              self.my_string1, self.my_string3, False)
 
+    # Probe
+    def check_probe(self, probe):
+        return probe.result == probe.my_addr1 and probe.unchanged
+
     # Properties
     func = "strpbrk"
+    probe_returns = True
+    compile_inputs = True
     tests = TestSetTest(init1, check1) & TestSetTest(init2, check2) & TestSetTest(init3, check3)
 
 
@@ -839,8 +913,15 @@ class TestMemset(Test):
                     result == self.my_addr1 + len(self.my_string1)-1,  # non-standard
                     self._ensure_mem(self.my_addr1, expected_mem.encode('utf-8'))])
 
+    # Probe
+    def check_probe(self, probe):
+        return probe.result in [probe.my_addr1,
+                                 probe.my_addr1 + probe.length - 1]
+
     # Properties
     func = "memset"
+    probe_returns = True
+    compile_inputs = True
     tests = TestSetTest(init1, check1)
 
 
@@ -925,6 +1006,7 @@ class TestMemmove(Test):
 
     # Properties
     func = "memmove"
+    compile_inputs = True
     tests = TestSetTest(init1, check1) & TestSetTest(init2, check2) & TestSetTest(init3, check3)
 
 
@@ -1006,8 +1088,14 @@ class TestMemmoveWeak(Test):
                     self._ensure_mem(self.my_addr1,
                                      self.my_string1[self.off:self.off+self.cpt].encode('utf-8'))])
 
+    # Probe
+    def check_probe(self, probe):
+        return probe.result == probe.my_addr1 and probe.unchanged
+
     # Properties
     func = "memmove"
+    probe_returns = True
+    compile_inputs = True
     tests = TestSetTest(init1, check1) & TestSetTest(init2, check2) & TestSetTest(init3, check3)
 
 
@@ -1074,6 +1162,7 @@ class TestMemcpy(TestMemmove):
     # Properties
     func = "memcpy"
     # At least one of the test2/test3 may fail for memcpy
+    compile_inputs = True
     tests = (TestSetTest(TestMemmove.init1, TestMemmove.check1) &
              (TestSetTest(TestMemmove.init2, check2) | TestSetTest(TestMemmove.init3, check3))
              )
@@ -1113,6 +1202,7 @@ class TestMemcpyWeak(TestMemmoveWeak):
     # Properties
     func = "memcpy"
     # At least one of the test2/test3 may fail for memcpy
+    compile_inputs = True
     tests = (
         TestSetTest(TestMemmoveWeak.init1, TestMemmoveWeak.check1) &
         (TestSetTest(TestMemmoveWeak.init2, check2) | TestSetTest(TestMemmoveWeak.init3, check3))
@@ -1135,8 +1225,14 @@ class TestStrrev(Test):
             return False
         return self._ensure_mem(self.my_addr, self.my_string[::-1].encode('utf-8') + b"\x00")
 
+    # Probe
+    def check_probe(self, probe):
+        return probe.result == probe.my_addr1
+
     # Properties
     func = "strrev"
+    probe_returns = True
+    compile_inputs = True
     tests = TestSetTest(init, check)
 
 
@@ -1197,8 +1293,14 @@ class TestMemcmp(Test):
         return self.my_check(self.my_addr1, self.my_addr3,
                              self.my_string1, self.my_string1)
 
+    # Probe
+    def check_probe(self, probe):
+        return self._to_int(probe.result) == 0 and probe.unchanged
+
     # Properties
     func = "memcmp"
+    probe_returns = True
+    compile_inputs = True
     tests = TestSetTest(init1, check1) & TestSetTest(init2, check2) & TestSetTest(init3, check3)
 
 
@@ -1230,6 +1332,7 @@ class TestBzero(Test):
 
     # Properties
     func = "bzero"
+    compile_inputs = True
     tests = TestSetTest(init1, check1) & TestSetTest(init2, check2)
 
 
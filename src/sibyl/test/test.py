@@ -29,7 +29,7 @@ else:
     from miasm.core.ctypesmngr import CAstTypes
     from miasm.arch.x86.ctype import CTypeAMD64_unk
 
-from sibyl.commons import HeaderFile
+from sibyl.commons import HeaderFile, pack_int, unpack_int
 
 
 class Test(object):
@@ -40,6 +40,9 @@ class Test(object):
     func = ""   # Possible function if test passes
     tests = []  # List of tests (init, check) to pass
     reset_mem = True  # Reset memory between tests
+    probe_returns = False  # Function expected to return on TestProbe input
+    fresh_inputs = False  # Draw random inputs again for each function
+    compile_inputs = False  # Inputs only set through helpers, can be recorded
 
     def init(self):
         "Called for setting up the test case"
@@ -50,6 +53,12 @@ class Test(object):
         Return True if all checks are passed"""
         return True
 
+    def check_probe(self, probe):
+        """Called once @probe (TestProbe instance) has been run on the
+        function, if it returned normally
+        Return False to rule out the function without launching tests"""
+        return True
+
     def reset_full(self):
         """Reset the test case between two functions"""
         self.alloc_pool = 0x20000000
@@ -64,6 +73,19 @@ class Test(object):
         self.jitter = jitter
         self.alloc_pool = 0x20000000
         self.abi = abi
+        # Inputs recorded instead of being set, see `record_inputs`
+        self._inputs = None
+
+    def record_inputs(self, init):
+        """Call @init without modifying the VM nor the ABI
+        Return the inputs it sets, as a tuple of (kind, address or argument
+        number, value)"""
+        self._inputs = []
+        try:
+            init(self)
+            return tuple(self._inputs)
+        finally:
+            self._inputs = None
 
     def _reserv_mem(self, size, read=True, write=False):
         right = 0
@@ -88,16 +110,24 @@ class Test(object):
             right |= PAGE_WRITE
 
         # Memory alignement
-        mem += bytes([random.randint(0, 255) for _ in range((16 - len(mem) % 16))])
+        mem += random.randbytes(16 - len(mem) % 16)
 
-        self.jitter.vm.add_memory_page(self.alloc_pool, right, mem)
+        self._add_page(self.alloc_pool, right, mem)
         to_ret = self.alloc_pool
         self.alloc_pool += len(mem) + 1
 
         return to_ret
 
+    def _add_page(self, addr, right, mem):
+        """Map @mem at @addr, with @right access (PAGE_READ | PAGE_WRITE),
+        for instance in memory reserved by `_reserv_mem`"""
+        if self._inputs is not None:
+            self._inputs.append(("page", addr, right, mem))
+        else:
+            self.jitter.vm.add_memory_page(addr, right, mem)
+
     def _alloc_mem(self, size, read=True, write=False):
-        mem = bytes([random.randint(0, 255) for _ in range(size)])
+        mem = random.randbytes(size)
         return self.__alloc_mem(mem, read=read, write=write)
 
     def _alloc_string(self, string, read=True, write=False):
@@ -105,17 +135,23 @@ class Test(object):
 
     def _alloc_pointer(self, pointer, read=True, write=False):
         pointer_size = self.abi.ira.sizeof_pointer()
-        return self.__alloc_mem(Test.pack(pointer, pointer_size),
+        return self.__alloc_mem(self.pack(pointer, pointer_size),
                                 read=read,
                                 write=write)
 
     def _write_mem(self, addr, element):
+        if self._inputs is not None:
+            self._inputs.append(("mem", addr, element))
+            return
         self.jitter.vm.set_mem(addr, element)
 
     def _write_string(self, addr, element):
         self._write_mem(addr, (element + "\x00").encode('utf-8'))
 
     def _add_arg(self, number, element):
+        if self._inputs is not None:
+            self._inputs.append(("arg", number, element))
+            return
         self.abi.add_arg(number, element)
 
     def _get_result(self):
@@ -132,12 +168,19 @@ class Test(object):
 
     def _ensure_mem_sparse(self, addr, element, offsets):
         """@offsets: offsets to ignore"""
-        for i, sub_element in enumerate(element):
-            if i in offsets:
-                continue
-            if not self._ensure_mem(addr + i, sub_element):
-                return False
-        return True
+        try:
+            mem = self.jitter.vm.get_mem(addr, len(element))
+        except RuntimeError:
+            # Ignored bytes may be unmapped: check the others one by one
+            return all(self._ensure_mem(addr + i, element[i:i + 1])
+                       for i in range(len(element)) if i not in offsets)
+
+        # Compare with @element, ignored bytes being taken from memory
+        expected = bytearray(element)
+        for offset in offsets:
+            if offset < len(expected):
+                expected[offset] = mem[offset]
+        return mem == expected
 
     def _as_int(self, element):
         int_size = self.abi.ira.sizeof_int()
@@ -154,29 +197,51 @@ class Test(object):
             element = self.jitter.vm.get_mem(addr, pointer_size)
         except RuntimeError:
             return False
-        return Test.unpack(element)
-
-    @staticmethod
-    def pack(element, size):
-        # orig_element = element
-        out = []
-        while element != 0:
-            # print('!!! [test.Test.pack] {}'.format(element % 0x100))
-            out.append(element % 0x100)
-            element >>= 8
-        if len(out) > size // 8:
-            raise ValueError("To big to be packed")
-        for _ in range(size // 8 - len(out)):
-            out.append(0)
-        out_ = bytes(out)
-        # print('!!! [test.Test.pack] 0x{:x}({}) -> {}'.format(orig_element, size, out_.hex()))
-        return out_
-
-    @staticmethod
-    def unpack(element):
-        i = int.from_bytes(element, byteorder='little', signed=False)
-        # print('!!! [test.Test.unpack] {} -> 0x{:x}'.format(element.hex(), i))
-        return i
+        return self.unpack(element)
+
+    def pack(self, element, size):
+        """Return the @size bits unsigned integer @element as bytes, in the
+        target byte order"""
+        return pack_int(element, size, self.abi.endianness)
+
+    def unpack(self, element):
+        """Return the unsigned integer stored in the bytes @element, in the
+        target byte order"""
+        return unpack_int(element, self.abi.endianness)
+
+
+class TestInputs(object):
+    """Inputs set by the init of a test, recorded to set them again without
+    calling it"""
+
+    def __init__(self, test, init):
+        """Record the inputs set by @init on @test"""
+        test.reset()
+        self.inputs = test.record_inputs(init)
+        # Test state after @init (allocated addresses, ...)
+        self.state = dict(vars(test))
+
+        # (address, access, content)
+        self.pages = [inp[1:] for inp in self.inputs if inp[0] == "page"]
+        # (address, content)
+        self.writes = [inp[1:] for inp in self.inputs if inp[0] == "mem"]
+        # (argument number, value)
+        self.args = [inp[1:] for inp in self.inputs if inp[0] == "arg"]
+
+        # Pages merged in a single image (address, content), unused space
+        # between them being filled with zeros
+        self.image = None
+        if self.pages:
+            start = min(addr for addr, _, _ in self.pages)
+            stop = max(addr + len(content) for addr, _, content in self.pages)
+            image = bytearray(stop - start)
+            for addr, _, content in self.pages:
+                image[addr - start:addr - start + len(content)] = content
+            self.image = (start, bytes(image))
+
+    def restore_state(self, test):
+        """Restore the state of @test after init, without setting inputs"""
+        test.__dict__.update(self.state)
 
 
 class TestSet(object):
@@ -199,6 +264,27 @@ class TestSet(object):
         """
         return NotImplementedError("Asbtract method")
 
+    def execute_batch(self, callback, candidates):
+        """Execute the test set on several @candidates at once
+        @callback: func(init, check, candidates) returning the list of
+        candidates passing the test (init, check)
+        Return the list of candidates passing the test set
+        """
+        # Default: one candidate at a time
+        return [candidate for candidate in candidates
+                if self.execute(lambda init, check: bool(
+                        callback(init, check, [candidate])))]
+
+    def conjuncts(self):
+        """Return the list of TestSetTest whose conjunction is equivalent to
+        this test set, or None if there is no such list"""
+        return None
+
+    def leaves(self):
+        """Return the list of TestSetTest in this test set, or None if they
+        are not known in advance"""
+        return None
+
 
 class TestSetAnd(TestSet):
     """Logic form : TestSet1 & TestSet2
@@ -224,6 +310,26 @@ class TestSetAnd(TestSet):
             # First test is valid
             return self._ts2.execute(callback)
 
+    def execute_batch(self, callback, candidates):
+        passed = self._ts1.execute_batch(callback, candidates)
+        if not passed:
+            return []
+        return self._ts2.execute_batch(callback, passed)
+
+    def conjuncts(self):
+        conjuncts1 = self._ts1.conjuncts()
+        conjuncts2 = self._ts2.conjuncts()
+        if conjuncts1 is None or conjuncts2 is None:
+            return None
+        return conjuncts1 + conjuncts2
+
+    def leaves(self):
+        leaves1 = self._ts1.leaves()
+        leaves2 = self._ts2.leaves()
+        if leaves1 is None or leaves2 is None:
+            return None
+        return leaves1 + leaves2
+
 
 class TestSetOr(TestSet):
     """Logic form : TestSet1 | TestSet2
@@ -248,6 +354,21 @@ class TestSetOr(TestSet):
         else:
             return self._ts2.execute(callback)
 
+    def execute_batch(self, callback, candidates):
+        passed = set(self._ts1.execute_batch(callback, candidates))
+        failed = [candidate for candidate in candidates
+                  if candidate not in passed]
+        if failed:
+            passed.update(self._ts2.execute_batch(callback, failed))
+        return [candidate for candidate in candidates if candidate in passed]
+
+    def leaves(self):
+        leaves1 = self._ts1.leaves()
+        leaves2 = self._ts2.leaves()
+        if leaves1 is None or leaves2 is None:
+            return None
+        return leaves1 + leaves2
+
 
 class TestSetTest(TestSet):
     """Terminal node of TestSet
@@ -269,6 +390,35 @@ class TestSetTest(TestSet):
     def execute(self, callback):
         return callback(self._init, self._check)
 
+    def execute_batch(self, callback, candidates):
+        if not candidates:
+            return []
+        return callback(self._init, self._check, candidates)
+
+    def conjuncts(self):
+        return [self]
+
+    def leaves(self):
+        return [self]
+
+    @property
+    def init(self):
+        return self._init
+
+    @property
+    def check(self):
+        return self._check
+
+    @property
+    def name(self):
+        """Name identifying the test in its test case"""
+        return self.test_name(self._init, self._check)
+
+    @staticmethod
+    def test_name(init, check):
+        """Name identifying the test (@init, @check) in its test case"""
+        return "%s/%s" % (init.__name__, check.__name__)
+
 
 class TestSetGenerator(TestSet):
     """TestSet based using a generator to retrieve tests"""
@@ -283,6 +433,48 @@ class TestSetGenerator(TestSet):
         return True
 
 
+class TestProbe(Test):
+    """Shared input, run once per function before tests
+
+    Its result is used to rule out test cases without running them (see
+    `Test.probe_returns` and `Test.check_probe`). Arguments are:
+    0. a pointer to a writable buffer containing `string`
+    1. a pointer to another writable buffer containing `string`
+    2. `length`
+    3. `length`
+    """
+
+    string = "Hello"
+    length = 3
+    buf_size = 0x40
+    compile_inputs = True
+
+    def init(self):
+        self.my_addr1 = self._alloc_mem(self.buf_size, write=True)
+        self._write_string(self.my_addr1, self.string)
+        self.my_addr2 = self._alloc_mem(self.buf_size, write=True)
+        self._write_string(self.my_addr2, self.string)
+
+        self._add_arg(0, self.my_addr1)
+        self._add_arg(1, self.my_addr2)
+        self._add_arg(2, self.length)
+        self._add_arg(3, self.length)
+
+    def check(self):
+        """Record the observed behavior:
+        - result: returned value
+        - unchanged: True if strings in buffers have not been modified
+        """
+        self.result = self._get_result()
+        string = (self.string + "\x00").encode('utf-8')
+        self.unchanged = all([self._ensure_mem(self.my_addr1, string),
+                              self._ensure_mem(self.my_addr2, string)])
+        return True
+
+    func = None
+    tests = TestSetTest(init, check)
+
+
 class TestHeader(Test):
     """Test extension with support for header parsing, and handling of struct
     offset, size, ...
@@ -17,25 +17,62 @@
 """This module provides a way to prepare and launch Sibyl tests on a binary"""
 
 
+import copy
+import json
 import time
+import random
+import operator
+import itertools
+from functools import reduce
 # import signal
 # import logging
 from miasm.analysis.binary import Container, ContainerPE, ContainerELF
 from miasm.core.locationdb import LocationDB
 
-from sibyl.commons import init_logger, END_ADDR  # , TimeoutException
+from sibyl.commons import init_logger, pack_int, END_ADDR  # , TimeoutException
 from sibyl.engine import QEMUEngine, MiasmEngine
 from sibyl.config import config
+from sibyl.test.test import (Test, TestInputs, TestProbe, TestSet,
+                             TestSetTest)
+from sibyl.cache import function_hashes, tests_version
+from sibyl.timeout import TimeoutPolicy
 
 
 class TestLauncher(object):
     "Launch tests for a function and report matching candidates"
 
     def __init__(self, filename_or_content, machine, abicls, tests_cls, engine_name,
-                 map_addr=0, early_quit_all=True):
-
-        # quit all tests when a timeout occurred
-        self.early_quit_all = early_quit_all
+                 map_addr=0, early_quit_all=True, snapshot_dir=None,
+                 cache=None, probe=True, stats=None, seed=None,
+                 crash_skip=True, budget=None):
+
+        # Bounds of the runs, and whether to quit all tests when a timeout
+        # occurred (sibyl.timeout.TimeoutPolicy instance). A boolean stands
+        # for fixed bounds
+        if isinstance(early_quit_all, bool):
+            early_quit_all = TimeoutPolicy(early_quit=early_quit_all)
+        self.timeout_policy = early_quit_all
+
+        # quit all tests when a function crashes the same way on different
+        # inputs
+        self.crash_skip = crash_skip
+
+        # Results cache (sibyl.cache.ResultCache instance), if any
+        self.cache = cache
+        # Precomputed function hashes: address -> portable hash, None if the
+        # function cannot be cached
+        self.function_hashes = {}
+
+        # Tests statistics (sibyl.stats.TestStats instance), if any
+        self.stats = stats
+
+        # Seed of random inputs, to reproduce a run. If None, they are
+        # random
+        self.seed = seed
+
+        # Callable called with the address about to be emulated, in batch
+        # mode, if any
+        self.progress = None
 
         # Logging facilities
         self.logger = init_logger("testlauncher")
@@ -44,6 +81,10 @@ class TestLauncher(object):
         self.machine = machine
         self.init_engine(engine_name)
 
+        # Maximum number of instructions executed per run, if any, instead of
+        # a wall-clock timeout. Runs are then reproducible, whatever the load
+        self.budget = budget
+
         # Init and snapshot VM
         if isinstance(filename_or_content, str):
             self.load_vm(filename_or_content, map_addr)
@@ -53,11 +94,32 @@ class TestLauncher(object):
             raise TypeError('The first arg should be str or bytes')
 
         self.init_stub()
-        self.snapshot = self.engine.take_snapshot()
+        self.snapshot = self.engine.take_snapshot(directory=snapshot_dir)
 
         # Init tests
         self.init_abi(abicls)
         self.initialize_tests(tests_cls)
+        self.compile_inputs()
+
+        # Shared input used to rule out tests, if any
+        self.probe = None
+        if probe:
+            self.probe = TestProbe(self.jitter, self.abi)
+            self.compiled_inputs[(self.probe, TestProbe.init)] = self.seeded(
+                TestInputs, self.probe, TestProbe.init)
+
+        # Elements of the cache key common to all functions
+        if self.cache is not None:
+            if probe:
+                tests_cls = list(tests_cls) + [TestProbe]
+            # Options changing the results
+            options = {"crash_skip": self.crash_skip,
+                       "budget": self.budget,
+                       "seed": self.seed,
+                       "timeout_policy": self.timeout_policy.describe()}
+            self.cache_context = [abicls.__name__, machine.name,
+                                  tests_version(tests_cls), engine_name,
+                                  json.dumps(options, sort_keys=True)]
 
     def init_stub(self):
         """Initialize stubbing capabilities"""
@@ -94,6 +156,123 @@ class TestLauncher(object):
         for testcls in tests_cls:
             tests.append(testcls(self.jitter, self.abi))
         self.tests = tests
+        if self.stats is not None:
+            self.schedule_tests()
+
+    def schedule_tests(self):
+        """Order tests, and sub-tests when possible, according to statistics:
+        the lower the emulation time per rejection, the sooner. Tests without
+        statistics are launched first, to get them"""
+        def sort_key(cost):
+            return (cost is not None, cost or 0)
+
+        for test in self.tests:
+            name = test.__class__.__name__
+            if not self.independent_subtests(test):
+                continue
+            conjuncts = test.tests.conjuncts()
+            # Sub-tests can be reordered only if they all must succeed
+            if conjuncts is None or len(conjuncts) < 2:
+                continue
+            conjuncts.sort(key=lambda subtest: sort_key(
+                self.stats.cost(name, subtest.name)))
+            test.tests = reduce(operator.and_, conjuncts)
+
+        self.tests.sort(key=lambda test: sort_key(
+            self.stats.cost(test.__class__.__name__)))
+
+    @staticmethod
+    def independent_subtests(test):
+        """Return the list of sub-tests of @test if they do not depend on each
+        other, ie. if memory and test state are reset between them.
+        Otherwise, return None"""
+        if (not isinstance(test.tests, TestSet) or not test.reset_mem or
+            type(test).reset is not Test.reset or
+            type(test).reset_full is not Test.reset_full):
+            return None
+        return test.tests.leaves()
+
+    def compile_inputs(self):
+        """Record the inputs set by independent sub-tests of tests setting
+        `compile_inputs`, to set them again without calling their init
+
+        Sub-tests setting the same inputs, in the same test case or not, are
+        also found. For a given function, they are emulated only once, and
+        all their checks are run on the resulting state"""
+        # Random parts of these inputs are drawn once, for all functions
+        self.inputs_seed = self.seed
+        if self.inputs_seed is None:
+            self.inputs_seed = random.getrandbits(64)
+
+        # (test, init) -> TestInputs instance
+        self.compiled_inputs = {}
+        # (test, init) -> (input addresses, input content), see `from_inputs`
+        self._input_values = {}
+        by_inputs = {}
+        for test in self.tests:
+            if test.fresh_inputs or not test.compile_inputs:
+                continue
+            for subtest in self.independent_subtests(test) or []:
+                key = (test, subtest.init)
+                if key not in self.compiled_inputs:
+                    self.compiled_inputs[key] = self.seeded(TestInputs, test,
+                                                            subtest.init)
+                by_inputs.setdefault(self.compiled_inputs[key].inputs,
+                                     []).append((test, subtest.init,
+                                                 subtest.check))
+
+        # (test, init, check) -> sub-tests with the same inputs
+        self.shared_inputs = {}
+        for subtests in by_inputs.values():
+            if len(subtests) > 1:
+                for subtest in subtests:
+                    self.shared_inputs[subtest] = subtests
+        # Results of the current functions: (address, (test, init, check)) ->
+        # (result, timeout flag)
+        self._shared_results = {}
+
+    def seeded(self, func, *args):
+        """Call @func(*@args) with the random generator seeded for shared
+        inputs, then restore the generator state"""
+        state = random.getstate()
+        random.seed(self.inputs_seed)
+        try:
+            return func(*args)
+        finally:
+            random.setstate(state)
+
+    def set_inputs(self, test, init, address=None):
+        """Set the inputs of @test, from its compiled @init if any
+        @address: tested function, whose inputs are drawn for if @init is not
+        compiled"""
+        compiled = self.compiled_inputs.get((test, init))
+        if compiled is None:
+            self.seed_fresh_inputs(address, test, init)
+            init(test)
+            return
+        compiled.restore_state(test)
+        self.engine.map_pages(compiled.pages, compiled.image)
+        for addr, content in compiled.writes:
+            self.jitter.vm.set_mem(addr, content)
+        for number, value in compiled.args:
+            self.abi.add_arg(number, value)
+
+    def share_results(self, subtest, address, status, timeout_flag):
+        """Run the checks of sub-tests sharing the inputs of @subtest, which
+        has just been emulated on @address and ended with @status"""
+        test, init, _ = subtest
+        for other in self.shared_inputs[subtest]:
+            if other == subtest or (address, other) in self._shared_results:
+                continue
+            other_test, other_init, other_check = other
+            # Set the test state (allocated addresses, ...)
+            self.compiled_inputs[(other_test, other_init)].restore_state(
+                other_test)
+            result = status and other_check(other_test)
+            self._shared_results[(address, other)] = (result, timeout_flag)
+
+        # Restore the state of @test, in case it has been modified
+        self.compiled_inputs[(test, init)].restore_state(test)
 
     def load_vm(self, filename, map_addr):
         self.ctr = Container.from_stream(open(filename, 'rb'), LocationDB(), vm=self.jitter.vm,
@@ -124,46 +303,361 @@ class TestLauncher(object):
         # Reset between functions
         test.reset_full()
 
+        # Statistics: number of sub-tests launched, emulation time
+        nb_subtests = [0]
+        total_time = [0.]
+
         # Callback to launch
         def launch_test(init, check):
             """Launch a test associated with @init, @check"""
 
+            subtest = (test, init, check)
+            shared = subtest in self.shared_inputs
+            if (address, subtest) in self._shared_results:
+                # Already checked on the state of another sub-test
+                to_ret, self.timeout_flag = self._shared_results[
+                    (address, subtest)]
+                self._temp_reset_mem = True
+                return to_ret
+            if self.crash_flags[address]:
+                return False
+
             # Reset state
             self.engine.restore_snapshot(memory=self._temp_reset_mem)
             self.abi.reset()
             test.reset()
 
             # Prepare VM
-            init(test)
+            self.set_inputs(test, init, address)
             self.abi.prepare_call(ret_addr=END_ADDR)
 
             # Run code
-            start_time = time.monotonic()
-            status = self.engine.run(address, timeout_seconds)
-            lap_time = time.monotonic() - start_time
-
-            self.timeout_flag = lap_time > timeout_seconds
+            status, lap_time, self.timeout_flag = self.emulate(
+                address, timeout_seconds)
 
             if not status:
                 # Early quit
                 self._temp_reset_mem = True
-                return False
-
-            # Check result
-            to_ret = check(test)
-
-            # Update flags
-            self._temp_reset_mem = test.reset_mem
-
+                to_ret = False
+                self.record_crash(address, test, init)
+            else:
+                # Check result
+                to_ret = check(test)
+
+                # Update flags
+                self._temp_reset_mem = test.reset_mem
+
+            if shared:
+                self.share_results(subtest, address, status,
+                                   self.timeout_flag)
+
+            if self.stats is not None:
+                nb_subtests[0] += 1
+                total_time[0] += lap_time
+                self.stats.record(test.__class__.__name__,
+                                  TestSetTest.test_name(init, check),
+                                  not to_ret, lap_time)
             return to_ret
 
         # Launch subtests
         status = test.tests.execute(launch_test)
+        if self.stats is not None:
+            self.stats.record(test.__class__.__name__, self.stats.ALL,
+                              not status, total_time[0],
+                              first_reject=not status and nb_subtests[0] == 1)
         if status:
             self._possible_funcs.append(test.func)
 
+    def emulate(self, address, timeout_seconds, calibrate=True):
+        """Run the function at @address on the prepared VM
+        Return (status, emulation time, timeout flag). The timeout flag is set
+        if the run exceeded @timeout_seconds or, if a budget is set, exhausted
+        it. Bounds are given by the timeout policy
+        @calibrate: if not set, the run is not accounted by the timeout policy
+        (as the probe, whose input is not the one of a test)"""
+        uncalibrated = self.timeout_policy.measure(address)
+        self.engine.budget = self.timeout_policy.budget(address, self.budget)
+        self.engine.measure = calibrate and uncalibrated
+        if self.engine.budget is not None and not uncalibrated:
+            # Only bounded by the budget, so that results do not depend on
+            # the load. Uncalibrated budgets keep the timeout as a backstop
+            timeout_seconds = 0
+        start_time = time.monotonic()
+        status = self.engine.run(address, timeout_seconds)
+        lap_time = time.monotonic() - start_time
+        if calibrate:
+            self.timeout_policy.observe(address, status, self.engine.executed)
+        if self.engine.budget is not None:
+            return status, lap_time, (self.engine.exhausted or
+                                      0 < timeout_seconds < lap_time)
+        return status, lap_time, lap_time > timeout_seconds
+
+    def run_prepared(self, prepare, addresses, timeout_seconds=0,
+                     calibrate=True):
+        """Run each of @addresses from the VM state set up by @prepare()
+        This state is prepared once, then restored between runs if the engine
+        supports it.
+        Yield (address, status, emulation time, timeout flag); the VM state
+        must be inspected before resuming
+        @calibrate: see `emulate`"""
+        state = None
+        for index, address in enumerate(addresses):
+            if state is not None:
+                self.engine.restore_state(state)
+            else:
+                self.engine.restore_snapshot()
+                self.abi.reset()
+                prepare()
+                self.abi.prepare_call(ret_addr=END_ADDR)
+                state = self.engine.save_state()
+
+            if self.progress is not None:
+                self.progress(address)
+            yield (address,) + self.emulate(address, timeout_seconds,
+                                            calibrate)
+
+    def launch_tests_batch(self, test, addresses, timeout_seconds=0):
+        """Launch @test on @addresses, running each sub-test on all the
+        addresses still candidates. Return the addresses passing @test"""
+        test.reset_full()
+
+        # Statistics: address -> number of sub-tests launched, emulation time
+        nb_subtests = dict.fromkeys(addresses, 0)
+        total_time = dict.fromkeys(addresses, 0.)
+
+        def launch_test(init, check, candidates):
+            """Launch a test associated with @init, @check on @candidates"""
+            subtest = (test, init, check)
+            shared = subtest in self.shared_inputs
+            passed = set()
+            to_run = []
+            for address in candidates:
+                if self.crash_flags[address]:
+                    continue
+                if (address, subtest) in self._shared_results:
+                    # Already checked on the state of another sub-test
+                    result, timeout_flag = self._shared_results[
+                        (address, subtest)]
+                    self.timeout_flags[address] |= timeout_flag
+                    if result:
+                        passed.add(address)
+                else:
+                    to_run.append(address)
+
+            def run(to_run):
+                """Run the sub-test on @to_run, from inputs set once"""
+                def prepare():
+                    test.reset()
+                    self.set_inputs(test, init, to_run[0])
+                return self.run_prepared(prepare, to_run, timeout_seconds)
+
+            if (test, init) in self.compiled_inputs:
+                runs = run(to_run)
+            else:
+                # Inputs are drawn for each address
+                runs = itertools.chain.from_iterable(run([address])
+                                                     for address in to_run)
+
+            for address, status, lap_time, timeout_flag in runs:
+                self.timeout_flags[address] |= timeout_flag
+                result = status and check(test)
+                if result:
+                    passed.add(address)
+                elif not status:
+                    self.record_crash(address, test, init)
+                if shared:
+                    self.share_results(subtest, address, status, timeout_flag)
+
+                if self.stats is not None:
+                    nb_subtests[address] += 1
+                    total_time[address] += lap_time
+                    self.stats.record(test.__class__.__name__,
+                                      TestSetTest.test_name(init, check),
+                                      not result, lap_time)
+
+            return [address for address in candidates if address in passed]
+
+        # Launch subtests
+        passed = test.tests.execute_batch(launch_test, addresses)
+        if self.stats is not None:
+            for address in addresses:
+                status = address in passed
+                self.stats.record(
+                    test.__class__.__name__, self.stats.ALL, not status,
+                    total_time[address],
+                    first_reject=not status and nb_subtests[address] == 1)
+        return passed
+
+    def run_probe_batch(self, addresses, timeout_seconds=0):
+        """Run the probe on @addresses
+        Return a dictionary address -> (probe status, as returned by
+        `run_probe`, probe state after its run)"""
+        def prepare():
+            self.probe.reset_full()
+            self.probe.reset()
+            self.set_inputs(self.probe, TestProbe.init)
+
+        statuses = {}
+        for address, status, _, timeout_flag in self.run_prepared(
+                prepare, addresses, timeout_seconds, calibrate=False):
+            self.timeout_flags[address] |= timeout_flag
+            if timeout_flag:
+                statuses[address] = (None, None)
+            elif status:
+                self.probe.check()
+                statuses[address] = (True, copy.copy(self.probe))
+            else:
+                statuses[address] = (False, None)
+                self.record_crash(address, self.probe, TestProbe.init)
+        return statuses
+
+    def run_probe(self, address, timeout_seconds=0):
+        """Run the probe on @address
+        Return True if it returned normally, False if it failed, None on
+        timeout (the timeout flag is then set, as for tests)"""
+        self.probe.reset_full()
+        self.engine.restore_snapshot()
+        self.abi.reset()
+        self.probe.reset()
+
+        self.set_inputs(self.probe, TestProbe.init)
+        self.abi.prepare_call(ret_addr=END_ADDR)
+
+        status, _, timeout_flag = self.emulate(address, timeout_seconds,
+                                               calibrate=False)
+        if timeout_flag:
+            # Could be due to the load, or a too small budget: do not conclude
+            self.timeout_flag = True
+            return None
+        if not status:
+            self.record_crash(address, self.probe, TestProbe.init)
+            return False
+        self.probe.check()
+        return True
+
+    def from_inputs(self, value, test, init):
+        """Return True if @value may be derived from the inputs of (@test,
+        @init), ie. if it is close to an argument or an input address, or if
+        its significant bytes (ignoring the lowest one) appear in input
+        memory. Unknown inputs are assumed to derive it"""
+        key = (test, init)
+        if key not in self._input_values:
+            compiled = self.compiled_inputs.get(key)
+            if compiled is None:
+                return True
+            addrs = set(arg for _, arg in compiled.args)
+            addrs.update(addr for addr, _, _ in compiled.pages)
+            addrs.update(addr for addr, _ in compiled.writes)
+            contents = [content for _, _, content in compiled.pages]
+            contents += [data for _, data in compiled.writes]
+            self._input_values[key] = (addrs, b"\0".join(contents))
+        addrs, contents = self._input_values[key]
+
+        if any(abs(value - addr) < 0x1000 for addr in addrs):
+            return True
+        pattern = pack_int(value, 64, self.abi.endianness)
+        if self.abi.endianness == "little":
+            pattern = pattern[1:].rstrip(b"\0")
+        else:
+            pattern = pattern[:-1].lstrip(b"\0")
+        return len(pattern) < 2 or pattern in contents
+
+    def record_crash(self, address, test, init):
+        """Record the crash of the last run of @address, on the inputs of
+        (@test, @init)
+
+        Remaining tests of @address are skipped if the crash does not depend
+        on inputs, ie. if:
+        - @address is not executable code;
+        - the same crash (kind, PC and faulting address) has already occurred
+        on other inputs, the faulting address being neither in the first page
+        nor derived from these inputs (see `from_inputs`).
+        """
+        crash = self.engine.crash
+        if not self.crash_skip or crash is None:
+            return
+        kind, _, fault = crash
+        if kind in ["fetch", "instruction"] and fault == address:
+            self.logger.info("Not executable: %s" % (crash,))
+            self.crash_flags[address] = True
+            return
+        if fault < 0x1000:
+            return
+
+        inputs = (test, init)
+        first = self._crashes.setdefault((address, crash), inputs)
+        if first == inputs or self.from_inputs(fault, *first) or \
+           self.from_inputs(fault, *inputs):
+            return
+        self.logger.info("Same crash on different inputs: %s" % (crash,))
+        self.crash_flags[address] = True
+
+    def probe_excluded(self, test, probe_status, probe=None):
+        """Return True if @test is ruled out by the probe, which ended with
+        @probe_status
+        @probe: (optional) probe state after its run, if not the current one
+        """
+        if not test.probe_returns or probe_status is None:
+            return False
+        return (not probe_status or
+                not test.check_probe(probe or self.probe))
+
+    def cache_key(self, address, *args, **kwargs):
+        """Return the cache key associated to the run of tests on @address,
+        or None if the function cannot be cached"""
+        if address in self.function_hashes:
+            func_hash = self.function_hashes[address]
+        else:
+            func_hash = function_hashes(self.machine, self.ctr, address)[0]
+        if func_hash is None:
+            return None
+        return self.cache.key(func_hash, repr((args, sorted(kwargs.items()))),
+                              *self.cache_context)
+
+    def cache_lookup(self, address, *args, **kwargs):
+        """Return (cache key, cached possible functions) for the run of tests
+        on @address. Both are None if unavailable"""
+        if self.cache is None:
+            return None, None
+        key = self.cache_key(address, *args, **kwargs)
+        if key is None:
+            return None, None
+        possible_funcs = self.cache.get(key)
+        if possible_funcs is not None:
+            self.logger.info("Cached result")
+        return key, possible_funcs
+
     def run(self, address, *args, **kwargs):
+        key, possible_funcs = self.cache_lookup(address, *args, **kwargs)
+        if possible_funcs is not None:
+            self._possible_funcs = possible_funcs
+            return possible_funcs
+
+        possible_funcs = self.run_tests(address, *args, **kwargs)
+
+        # Timeouts depend on the load: do not cache the result
+        if key is not None and not self.timeout_flag:
+            self.cache.set(key, possible_funcs)
+        return possible_funcs
+
+    def seed_fresh_inputs(self, address, test, init):
+        """Seed the random generator for inputs drawn by @init of @test while
+        testing @address, if a seed is set. They are then the same whatever
+        the tests run before, and the addresses tested along in batch mode"""
+        if self.seed is not None:
+            random.seed("%d:%x:%s.%s" % (self.seed, address,
+                                         test.__class__.__name__,
+                                         init.__name__))
+
+    def run_tests(self, address, *args, **kwargs):
         self._possible_funcs = []
+        self._shared_results = {}
+        self.timeout_flag = False
+        # (address, crash signature) -> first inputs on which it occurred
+        self._crashes = {}
+        # address -> remaining tests are skipped due to crashes
+        self.crash_flags = {address: False}
+        self.timeout_policy.start([address])
 
         nb_tests = len(self.tests)
         self.logger.info("Launch tests (%d available functions)" % (nb_tests))
@@ -171,15 +665,92 @@ class TestLauncher(object):
 
         self.engine.prepare_run()
 
+        probe_status = None
+        if self.probe is not None:
+            probe_status = self.run_probe(address, *args, **kwargs)
+
         for test in self.tests:
             # print('!!! [testlauncher.run] {test}')
-            self.launch_tests(test, address, *args, **kwargs)
-            if self.early_quit_all and self.timeout_flag:
+            if self.timeout_policy.early_quit and self.timeout_flag:
+                break
+            if self.crash_flags[address]:
                 break
+            if self.probe_excluded(test, probe_status):
+                continue
+            self.launch_tests(test, address, *args, **kwargs)
 
         self.logger.info("Total time: %.4f seconds" % (time.time() - starttime))
         return self._possible_funcs
 
+    def run_batch(self, addresses, *args, **kwargs):
+        """Run tests on @addresses, preparing each sub-test once for all the
+        addresses still candidates
+        Return a dictionary address -> possible functions"""
+        results = {}
+        keys = {}
+        for address in addresses:
+            keys[address], possible_funcs = self.cache_lookup(address, *args,
+                                                              **kwargs)
+            if possible_funcs is not None:
+                results[address] = possible_funcs
+        todo = [address for address in addresses if address not in results]
+        if not todo:
+            return results
+
+        results.update(self.run_tests_batch(todo, *args, **kwargs))
+
+        # Timeouts depend on the load: do not cache these results
+        for address in todo:
+            if keys[address] is not None and not self.timeout_flags[address]:
+                self.cache.set(keys[address], results[address])
+        return results
+
+    def run_tests_batch(self, addresses, timeout_seconds=0):
+        """Run tests on @addresses, see `run_batch`"""
+        possible_funcs = {address: [] for address in addresses}
+        # address -> a timeout occurred
+        self.timeout_flags = dict.fromkeys(addresses, False)
+        self._shared_results = {}
+        self._crashes = {}
+        self.crash_flags = dict.fromkeys(addresses, False)
+        self.timeout_policy.start(addresses)
+
+        self.logger.info("Launch tests on %d addresses (%d available "
+                         "functions)" % (len(addresses), len(self.tests)))
+        starttime = time.time()
+
+        self.engine.prepare_run()
+
+        probe_status = dict.fromkeys(addresses, (None, None))
+        if self.probe is not None:
+            probe_status = self.run_probe_batch(addresses, timeout_seconds)
+
+        for test in self.tests:
+            candidates = [address for address in addresses
+                          if not self.probe_excluded(test,
+                                                     *probe_status[address])
+                          and not (self.timeout_policy.early_quit and
+                                   self.timeout_flags[address])
+                          and not self.crash_flags[address]]
+            if self.independent_subtests(test) is not None:
+                passed = self.launch_tests_batch(test, candidates,
+                                                 timeout_seconds)
+                for address in passed:
+                    possible_funcs[address].append(test.func)
+                continue
+
+            # Sub-tests depend on each other: one address at a time
+            for address in candidates:
+                if self.progress is not None:
+                    self.progress(address)
+                self._possible_funcs = possible_funcs[address]
+                self.timeout_flag = False
+                self.launch_tests(test, address, timeout_seconds)
+                self.timeout_flags[address] |= self.timeout_flag
+
+        self.logger.info("Total time: %.4f seconds" % (time.time() - starttime))
+        return possible_funcs
+
     def get_possible_funcs(self):
         return self._possible_funcs
     possible_funcs = property(get_possible_funcs)
@@ -0,0 +1,92 @@
+"""Policies bounding the emulation of tests on a function"""
+
+
+class TimeoutPolicy(object):
+    """Fixed bounds: each run is limited by the test timeout or, if set, the
+    instruction budget
+
+    @early_quit: if set, the remaining tests of a function are skipped once
+    one of its runs has exceeded its bound
+    """
+
+    name = "fixed"
+
+    def __init__(self, early_quit=True):
+        self.early_quit = early_quit
+
+    def start(self, addresses):
+        """Forget what has been observed before testing @addresses"""
+        pass
+
+    def budget(self, address, default):
+        """Return the instruction budget of the next run on @address, None
+        for its timeout only
+        @default: budget requested by the user, if any"""
+        return default
+
+    def measure(self, address):
+        """Return True if instructions executed by the next run on @address
+        have to be counted. Such runs are also bounded by the test timeout,
+        in addition to their budget"""
+        return False
+
+    def observe(self, address, status, executed):
+        """Account for a run on @address, ending with @status, which executed
+        @executed instructions (None if not counted)"""
+        pass
+
+    def describe(self):
+        """Return a JSON serializable description of the policy"""
+        return {"name": self.name,
+                "early_quit": self.early_quit}
+
+
+class AdaptiveTimeout(TimeoutPolicy):
+    """Per function budget, calibrated on its cost
+
+    Runs of tests on a function are bounded by @first_budget, and the test
+    timeout, until one of them returns normally. Next ones are bounded by
+    @factor times the number of instructions it executed, in [@minimum,
+    @first_budget].
+
+    Endless loops are then stopped early, while slow functions still get a
+    budget fitting their cost.
+    """
+
+    name = "adaptive"
+
+    # Default parameters
+    FIRST_BUDGET = 10000000
+    FACTOR = 100
+    MINIMUM = 10000
+
+    def __init__(self, early_quit=True, first_budget=FIRST_BUDGET,
+                 factor=FACTOR, minimum=MINIMUM):
+        super(AdaptiveTimeout, self).__init__(early_quit=early_quit)
+        self.first_budget = first_budget
+        self.factor = factor
+        self.minimum = minimum
+        # address -> calibrated budget
+        self.budgets = {}
+
+    def start(self, addresses):
+        self.budgets.clear()
+
+    def budget(self, address, default):
+        return self.budgets.get(address, self.first_budget)
+
+    def measure(self, address):
+        return address not in self.budgets
+
+    def observe(self, address, status, executed):
+        if not status or executed is None or address in self.budgets:
+            return
+        self.budgets[address] = min(max(executed * self.factor, self.minimum),
+                                    self.first_budget)
+
+    def describe(self):
+        description = super(AdaptiveTimeout, self).describe()
+        description.update({"first_budget": self.first_budget,
+                            "factor": self.factor,
+                            "minimum": self.minimum})
+        return description
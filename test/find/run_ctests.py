@@ -2,7 +2,10 @@
 
 import os
 import re
+import json
+import shutil
 import subprocess
+import tempfile
 from argparse import ArgumentParser
 from utils.log import log_error, log_success, log_info
 
@@ -11,7 +14,17 @@ from sibyl.heuristics.func import FuncHeuristic
 
 match_C = re.compile("\w+[ \*]+(\w+)\(.*\)")
 custom_tag = "my_"
-whitelist_funcs = ["main"]
+# Functions not expected to be found: matching the C pattern without being
+# functions (asm operands), never returning, ...
+whitelist_funcs = ["main", "strlen_literal", "strcpy_literal", "spin"]
+# Architecture and ABI of test binaries not built for x86_32
+binary_arch = {"test_dedup": ("x86_64", "ABI_AMD64_SYSTEMV"),
+               "test_trap": ("x86_64", "ABI_AMD64_SYSTEMV")}
+# Binaries also tested with the QEMU engine, in this order: the second one is
+# run with the results cache filled by the first one
+qemu_binaries = ["test_trap", "test_dedup"]
+# Binary providing the never returning "spin" function
+spin_binary = "test_trap"
 
 
 def get_funcs_exe_source(c_file, filename):
@@ -33,14 +46,16 @@ def get_funcs_exe_source(c_file, filename):
     if sect != None:
         for name, symb in sect.symbols.items():
             offset = symb.value
-            if name.startswith(b"__"):
+            name = name.decode()
+            if name.startswith("__"):
                 name = name[2:]
             symbols.setdefault(name, set()).add(offset)
             if name in funcs:
                 if name.startswith(custom_tag):
                     ## Custom tags can be used to write equivalent functions like
-                    ## 'my_strlen' for a custom strlen
-                    name = name[len(custom_tag):]
+                    ## 'my_strlen' for a custom strlen, or 'my_strlen_a' for
+                    ## one of its copies
+                    name = name[len(custom_tag):].split("_")[0]
                 to_check.append((offset, name))
 
     return to_check, symbols
@@ -75,6 +90,142 @@ def get_funcs_heuristics(c_file, filename):
     return to_check, extra
 
 
+def run_sibyl(cmd, env=None):
+    """Launch the Sibyl command @cmd and return its standard output
+    @env: environment of the process, if not the current one"""
+    print(" ".join(cmd))
+    sibyl = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE, text=True, env=env)
+    stdout, stderr = sibyl.communicate()
+    if sibyl.returncode:
+        log_error("Process exits with a %d code" % sibyl.returncode)
+        print(stderr)
+        exit(sibyl.returncode)
+    return stdout
+
+
+def launch_sibyl(filename, options, to_check, env=None):
+    """Launch Sibyl on @filename, for the addresses of @to_check
+    @env: environment of the process, if not the current one
+    Return the list of (address, function) found"""
+    cmd = ["sibyl", "find"] + options + [filename]
+    cmd += [hex(addr) for addr, _ in to_check]
+    stdout = run_sibyl(cmd, env)
+
+    # Parse result
+    found = []
+    for line in stdout.split("\n"):
+        if not line or not " : " in line:
+            continue
+        addr, func = line.split(" : ")
+        found.append((int(addr, 0), func))
+    return found
+
+
+def launch_sibyl_ndjson(filename, options, addresses, env=None):
+    """Launch Sibyl on @filename, for @addresses, with a NDJSON output
+    @env: environment of the process, if not the current one
+    Return the list of (address, function) found, and the error of each
+    address"""
+    cmd = ["sibyl", "find", "-o", "NDJSON"] + options + [filename]
+    cmd += [hex(addr) for addr in addresses]
+    lines = run_sibyl(cmd, env).split("\n")
+
+    # Parse result: the run information, then one line per address
+    information = json.loads(lines[0])["information"]
+    if information["total_count"] != len(addresses):
+        log_error("Bad address count: %d" % information["total_count"])
+    found = []
+    errors = {}
+    for line in lines[1:]:
+        if not line:
+            continue
+        result = json.loads(line)
+        if result["address"] in errors:
+            log_error("Address reported twice: 0x%08x" % result["address"])
+        errors[result["address"]] = result["error"]
+        found += [(result["address"], func) for func in result["functions"]]
+    if sorted(errors) != sorted(addresses):
+        log_error("Missing addresses in NDJSON output")
+    return found, errors
+
+
+def compare_runs(name, reference, found):
+    """Check that the run @name @found the same elements as @reference"""
+    for offset, name_found in sorted(set(found) - set(reference)):
+        log_error("%s: additional found: %s (@0x%08x)" % (name, name_found,
+                                                            offset))
+    for offset, name_expected in sorted(set(reference) - set(found)):
+        log_error("%s: not found: %s (@0x%08x)" % (name, name_expected,
+                                                   offset))
+    if sorted(found) == sorted(reference):
+        log_success("%s: same results" % name)
+
+
+def test_qemu(env):
+    """Launch Sibyl with the QEMU engine on @qemu_binaries, bounded by an
+    instruction budget then an adaptive one. The probe is disabled, so that
+    all the tests are run, including the ones on which functions trap
+    Then fill the results cache and use it, check the recorded statistics,
+    and the recycling of a worker stuck on a never returning function
+    @env: environment of Sibyl processes, sharing the cache and statistics
+    """
+    for filename in qemu_binaries:
+        log_info( " %s (QEMU):" % filename )
+        to_check, symbols = get_funcs_exe_source(filename + ".c", filename)
+        arch, abi = binary_arch[filename]
+        options = ["-j", "qemu", "-i", "5", "-a", arch, "-b", abi, "-P"]
+
+        log_info( "Launch Sibyl with an instruction budget" )
+        compare_runs("Budget", to_check,
+                     launch_sibyl(filename,
+                                  options + ["-n", "-u", "1000000"],
+                                  to_check, env=env))
+
+        log_info( "Launch Sibyl with adaptive budgets" )
+        compare_runs("Adaptive", to_check,
+                     launch_sibyl(filename, options + ["-n", "-A"],
+                                  to_check, env=env))
+
+        # The first run fills the cache, shared with the previous binaries,
+        # the second one only uses it
+        log_info( "Launch Sibyl with the results cache" )
+        compare_runs("Cache filling", to_check,
+                     launch_sibyl(filename, options + ["-u", "1000000"],
+                                  to_check, env=env))
+        found, errors = launch_sibyl_ndjson(filename,
+                                            options + ["-u", "1000000"],
+                                            [addr for addr, _ in to_check],
+                                            env=env)
+        compare_runs("Cached (NDJSON)", to_check, found)
+        for addr, error in sorted(errors.items()):
+            if error:
+                log_error("Unexpected error on 0x%08x: %s" % (addr, error))
+
+        if filename != spin_binary:
+            continue
+        log_info( "Launch Sibyl on a never returning function" )
+        spin_addrs = sorted(symbols["spin"])
+        found, errors = launch_sibyl_ndjson(filename,
+                                            options + ["-n", "-T", "1"],
+                                            spin_addrs + [addr for addr, _
+                                                          in to_check],
+                                            env=env)
+        compare_runs("Worker recycling", to_check, found)
+        for addr in spin_addrs:
+            if errors[addr] != "timeout":
+                log_error("Bad error on 0x%08x: %s" % (addr, errors[addr]))
+
+    log_info( "Check tests statistics" )
+    stdout = run_sibyl(["sibyl", "config", "-s"], env)
+    tests = [line.split("|")[0].strip() for line in stdout.split("\n")
+             if line.startswith("Test") and not line.startswith("Test ")]
+    if not tests:
+        log_error("No statistics recorded")
+    else:
+        log_success("Statistics recorded for %d tests" % len(tests))
+
+
 def test_find(args):
 
     if args.func_heuristic:
@@ -107,29 +258,12 @@ def test_find(args):
 
         # Launch Sibyl
         log_info( "Launch Sibyl" )
-        options = ["-j", "gcc", "-i", "5", "-b", "ABIStdCall_x86_32"]
+        arch, abi = binary_arch.get(filename, ("x86_32", "ABIStdCall_x86_32"))
+        options = ["-j", "gcc", "-i", "5", "-b", abi]
         if not args.arch_heuristic:
-            options += ["-a", "x86_32"]
-
-        cmd = ["sibyl", "find"] + options + [filename]
-        cmd += [hex(addr) for addr, _ in to_check]
-        print(" ".join(cmd))
-        sibyl = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                                 stderr=subprocess.PIPE, text=True)
-
-        # Parse result
-        found = []
-        stdout, stderr = sibyl.communicate()
-        for line in stdout.split("\n"):
-            if not line or not " : " in line:
-                continue
-            addr, func = line.split(" : ")
-            found.append((int(addr, 0), func))
-
-        if sibyl.returncode:
-            log_error("Process exits with a %d code" % sibyl.returncode)
-            print(stderr)
-            exit(sibyl.returncode)
+            options += ["-a", arch]
+
+        found = launch_sibyl(filename, options, to_check)
 
         log_info( "Evaluate results" )
         i = 0
@@ -155,6 +289,27 @@ def test_find(args):
 
         log_success("Found %d/%d correct elements" % (i, len(to_check)))
 
+        # Other modes must give the same results, without using the cache
+        log_info( "Launch Sibyl in batch mode" )
+        compare_runs("Batch mode", found,
+                     launch_sibyl(filename, options + ["-n", "-B"], to_check))
+
+        log_info( "Launch Sibyl on half of the addresses, then resume" )
+        checkpoint = "%s.checkpoint" % filename
+        if os.path.exists(checkpoint):
+            os.remove(checkpoint)
+        options_checkpoint = options + ["-n", "-c", checkpoint]
+        launch_sibyl(filename, options_checkpoint,
+                     to_check[:(len(to_check) + 1) // 2])
+        compare_runs("Resumed run", found,
+                     launch_sibyl(filename, options_checkpoint, to_check))
+        os.remove(checkpoint)
+
+    # Start from an empty cache and statistics
+    home = tempfile.mkdtemp(prefix="sibyl-")
+    test_qemu(dict(os.environ, HOME=home))
+    shutil.rmtree(home)
+
     log_info( "Remove old files" )
     os.system("make clean")
     return False
@@ -0,0 +1,103 @@
+/*
+ * This file is part of Sibyl.
+ * Copyright 2014 Camille MOUGEY <camille.mougey@cea.fr>
+ *
+ * Sibyl is free software: you can redistribute it and/or modify it
+ * under the terms of the GNU General Public License as published by
+ * the Free Software Foundation, either version 3 of the License, or
+ * (at your option) any later version.
+ *
+ * Sibyl is distributed in the hope that it will be useful, but WITHOUT
+ * ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+ * or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public
+ * License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with Sibyl. If not, see <http://www.gnu.org/licenses/>.
+ */
+
+/* Functions sharing their code, identified once by Sibyl
+ *
+ * Names are "my_<function>_<variant>"
+ */
+
+#include <stddef.h>
+
+/* Duplicated bodies */
+
+size_t my_strlen_a(const char *s) {
+	size_t i = 0;
+	while (s[i])
+		i++;
+	return i;
+}
+
+size_t my_strlen_b(const char *s) {
+	size_t i = 0;
+	while (s[i])
+		i++;
+	return i;
+}
+
+char* my_strcpy_a(char *dst, const char *src) {
+	char *ret = dst;
+	while ((*dst++ = *src++));
+	return ret;
+}
+
+char* my_strcpy_b(char *dst, const char *src) {
+	char *ret = dst;
+	while ((*dst++ = *src++));
+	return ret;
+}
+
+/* Byte-identical thunks, jumping to the address stored in their own
+ * literal. They must not be identified as copies of each other */
+
+__asm__(".text\n"
+	".p2align 5\n"
+	".globl my_strlen_thunk\n"
+	"my_strlen_thunk:\n"
+	"	mov strlen_literal(%rip), %rax\n"
+	"	jmp *%rax\n"
+	".p2align 3\n"
+	"strlen_literal: .quad my_strlen_a\n"
+	".p2align 5\n"
+	".globl my_strcpy_thunk\n"
+	"my_strcpy_thunk:\n"
+	"	mov strcpy_literal(%rip), %rax\n"
+	"	jmp *%rax\n"
+	".p2align 3\n"
+	"strcpy_literal: .quad my_strcpy_a\n");
+
+/* Byte-identical wrappers, calling different functions. They must not be
+ * identified as copies of each other */
+
+__asm__(".text\n"
+	".p2align 5\n"
+	".globl my_strlen_call\n"
+	"my_strlen_call:\n"
+	"	sub $8, %rsp\n"
+	"	call my_strlen_a\n"
+	"	add $8, %rsp\n"
+	"	ret\n"
+	".p2align 5\n"
+	".globl my_strcpy_call\n"
+	"my_strcpy_call:\n"
+	"	sub $8, %rsp\n"
+	"	call my_strcpy_a\n"
+	"	add $8, %rsp\n"
+	"	ret\n");
+
+size_t my_strlen_thunk(const char *s);
+char* my_strcpy_thunk(char *dst, const char *src);
+size_t my_strlen_call(const char *s);
+char* my_strcpy_call(char *dst, const char *src);
+
+int main() {
+	char buf[0x10];
+	my_strcpy_b(buf, "test");
+	my_strcpy_thunk(buf, "test");
+	my_strcpy_call(buf, "test");
+	return my_strlen_b(buf) + my_strlen_thunk(buf) + my_strlen_call(buf);
+}
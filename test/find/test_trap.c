@@ -0,0 +1,49 @@
+/*
+ * This file is part of Sibyl.
+ * Copyright 2014 Camille MOUGEY <camille.mougey@cea.fr>
+ *
+ * Sibyl is free software: you can redistribute it and/or modify it
+ * under the terms of the GNU General Public License as published by
+ * the Free Software Foundation, either version 3 of the License, or
+ * (at your option) any later version.
+ *
+ * Sibyl is distributed in the hope that it will be useful, but WITHOUT
+ * ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+ * or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public
+ * License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with Sibyl. If not, see <http://www.gnu.org/licenses/>.
+ */
+
+/* Functions ending in a CPU exception on some inputs, or never returning
+ *
+ * Names are "my_<function>_<variant>"
+ */
+
+int my_atoi_a(const char *s) {
+	int n = 0;
+	while (*s >= '0' && *s <= '9')
+		n = n * 10 + *s++ - '0';
+	return n;
+}
+
+/* Trap on inputs not starting with a digit, such as the ones of strlen. This
+ * only rejects the current test, unlike a timeout */
+int my_atoi_trap(const char *s) {
+	int n = 0;
+	if (*s < '0' || *s > '9')
+		__asm__ volatile("int3");
+	while (*s >= '0' && *s <= '9')
+		n = n * 10 + *s++ - '0';
+	return n;
+}
+
+/* Never returns: without instruction budget, its worker must be recycled */
+void spin(void) {
+	while (1);
+}
+
+int main() {
+	return my_atoi_a("1") + my_atoi_trap("2");
+}